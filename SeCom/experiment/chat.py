@@ -2,14 +2,16 @@
 # Licensed under The MIT License [see LICENSE for details]
 
 import argparse
+import asyncio
 import json
 import os
 
 from metrics import evaluate_match, evaluate_sim
 from tqdm import tqdm
-from utils import LocalLLM, OpenAILLM
+from utils import LocalLLM
 
-from secom import SeCom
+from secom import SeCom, llm_metrics
+from secom.utils import OpenAILLM
 
 MTBP_PROMPT = """
 You are an intelligent dialog bot. You will be shown Related Evidences supporting for User Input, and Recent Dialogs between user and you. Please read, memorize, and understand given materials, then generate one concise, coherent and helpful response.
@@ -29,6 +31,17 @@ parser.add_argument(
 parser.add_argument(
     "--save_path", default="result/mtbp/retrieval/mpnet/mistral/answer-k1_mtbp.jsonl"
 )
+parser.add_argument(
+    "--max_concurrency",
+    type=int,
+    default=64,
+    help="the maximum number of requests in flight to an openai model",
+)
+parser.add_argument(
+    "--llm_metrics_path",
+    default="",
+    help="json file of the token usage and latency of the answering calls, default to llm_<metrics file>",
+)
 args = parser.parse_args()
 os.makedirs(os.path.dirname(args.save_path), exist_ok=True)
 
@@ -66,22 +79,70 @@ if os.path.exists(args.save_path):
     for sample in results:
         processed_ids.add(sample["conversation_id"])
 
-for idx, sample in enumerate(tqdm(data)):
+
+# conversations answered concurrently finish out of order, the results are saved in the order of the input
+input_order = {sample["conversation_id"]: idx for idx, sample in enumerate(data)}
+
+
+def save_results():
+    results.sort(
+        key=lambda sample: input_order.get(sample["conversation_id"], len(data))
+    )
+    with open(args.save_path, "w", encoding="utf-8") as f:
+        f.writelines([json.dumps(_, ensure_ascii=False) + "\n" for _ in results])
+
+
+async def answer_concurrently(samples):
+    # the answers of all conversations share one connection pool, a conversation is saved once it is answered
+    semaphore = asyncio.Semaphore(args.max_concurrency)
+
+    async def answer(prompt):
+        async with semaphore:
+            return await llm.acall(prompt)
+
+    async def answer_sample(sample):
+        sample["pred_answers"] = await asyncio.gather(
+            *[
+                answer(MTBP_PROMPT.format(context=context, question=request))
+                for request, context in zip(
+                    sample["questions"], sample["retrieved_texts"]
+                )
+            ]
+        )
+        return sample
+
+    async with llm:
+        for future in tqdm(
+            asyncio.as_completed([answer_sample(sample) for sample in samples]),
+            total=len(samples),
+        ):
+            results.append(await future)
+            save_results()
+
+
+pending = []
+for sample in data:
     if sample["conversation_id"] in processed_ids:
         print(f"{sample['conversation_id']} is processed")
         continue
-    print(f"answering {idx}-th conversation")
-    requests = sample["questions"]
-    retrieved_texts = sample["retrieved_texts"]
-    pred_answers = []
-    for request, context in zip(requests, retrieved_texts):
-        prompt = MTBP_PROMPT.format(context=context, question=request)
-        response = llm(prompt)
-        pred_answers.append(response)
-    sample["pred_answers"] = pred_answers
-    results.append(sample)
-    with open(args.save_path, "w", encoding="utf-8") as f:
-        f.writelines([json.dumps(_, ensure_ascii=False) + "\n" for _ in results])
+    pending.append(sample)
+
+with llm_metrics.site("chat"):
+    if hasattr(llm, "acall") and args.max_concurrency > 1:
+        asyncio.run(answer_concurrently(pending))
+    else:
+        for idx, sample in enumerate(tqdm(pending)):
+            print(f"answering {idx}-th conversation")
+            requests = sample["questions"]
+            retrieved_texts = sample["retrieved_texts"]
+            pred_answers = []
+            for request, context in zip(requests, retrieved_texts):
+                prompt = MTBP_PROMPT.format(context=context, question=request)
+                response = llm(prompt)
+                pred_answers.append(response)
+            sample["pred_answers"] = pred_answers
+            results.append(sample)
+            save_results()
 
 
 def get_answer(ans):
@@ -127,3 +188,10 @@ with open(
     encoding="utf-8",
 ) as f:
     json.dump(metrics, f)
+llm_metrics.dump(
+    args.llm_metrics_path
+    or os.path.join(
+        metrics_dir,
+        "llm_" + os.path.basename(args.save_path).replace("answer", "metrics"),
+    )
+)
@@ -13,6 +13,11 @@ from secom import SeCom
 parser = argparse.ArgumentParser(description="compress segments.")
 parser.add_argument("--load_path", default="result/mtbp/gpt4seg_mtbp.jsonl")
 parser.add_argument("--save_path", default="result/mtbp/llmlingua2comp_mtbp.jsonl")
+parser.add_argument(
+    "--cache_path",
+    default="result/cache/compression.sqlite",
+    help="compression cache shared by runs and granularities, empty to disable",
+)
 
 args = parser.parse_args()
 os.makedirs(os.path.dirname(args.save_path), exist_ok=True)
@@ -37,6 +42,8 @@ data = load_data(args.load_path)
 print(f"number of data: {len(data)}")
 
 secom = SeCom()
+if args.cache_path:
+    secom.init_compress_cache(args.cache_path)
 
 results = []
 processed_ids = set()
@@ -65,3 +72,6 @@ for idx, sample in enumerate(tqdm(data)):
 
     with open(args.save_path, "w", encoding="utf-8") as f:
         f.writelines([json.dumps(_, ensure_ascii=False) + "\n" for _ in results])
+
+if secom.compress_cache is not None:
+    print(f"compression cache: {secom.compress_cache.stats()}")
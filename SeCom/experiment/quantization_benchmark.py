@@ -0,0 +1,112 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from secom.vectorstore import FlatVectorStore
+
+parser = argparse.ArgumentParser(
+    description="memory and recall of quantized FlatVectorStore storage."
+)
+parser.add_argument(
+    "--vectors_path",
+    default="",
+    help="a .npy matrix of memory unit embeddings, synthetic clustered vectors if empty",
+)
+parser.add_argument("--n_docs", type=int, default=20000)
+parser.add_argument("--n_queries", type=int, default=500)
+parser.add_argument("--dim", type=int, default=768)
+parser.add_argument("--topk", type=int, default=10)
+parser.add_argument("--rescore_factor", type=int, default=4)
+parser.add_argument(
+    "--rescore_dir",
+    default="result/quantization/rescore",
+    help="a directory on disk for the float32 vectors of rescore, not tmpfs",
+)
+parser.add_argument("--save_path", default="")
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+if args.vectors_path:
+    vectors = np.load(args.vectors_path).astype(np.float32)
+    # held-out memory units, perturbed, stand in for the requests
+    rng.shuffle(vectors)
+    queries, vectors = vectors[: args.n_queries], vectors[args.n_queries :]
+    queries = queries + 0.1 * vectors.std() * rng.standard_normal(queries.shape).astype(
+        np.float32
+    )
+else:
+    # clustered vectors with uneven norms, like the unnormalized dot-product embeddings of mpnet
+    centers = rng.standard_normal((200, args.dim)).astype(np.float32)
+    labels = rng.integers(0, len(centers), args.n_docs + args.n_queries)
+    points = centers[labels] + 0.5 * rng.standard_normal(
+        (len(labels), args.dim)
+    ).astype(np.float32)
+    points *= rng.uniform(0.5, 1.5, (len(labels), 1)).astype(np.float32)
+    vectors, queries = points[: args.n_docs], points[args.n_docs :]
+print(f"number of memory units: {len(vectors)}, requests: {len(queries)}")
+
+
+def build(**kwargs):
+    store = FlatVectorStore(None, **kwargs)
+    store.add_vectors([None] * len(vectors), vectors)
+    return store
+
+
+def search(store):
+    store.search_by_vectors(queries[:10], args.topk)
+    start = time.perf_counter()
+    rows, _ = store.search_by_vectors(queries, args.topk)
+    return rows, time.perf_counter() - start
+
+
+reference, _ = search(build())
+settings = [
+    {"dtype": "float32"},
+    {"dtype": "float16"},
+    {"dtype": "float16", "rescore": True},
+    {"dtype": "int8"},
+    {"dtype": "int8", "rescore": True},
+]
+results = []
+for setting in settings:
+    if setting.get("rescore"):
+        setting = {**setting, "rescore_dir": args.rescore_dir}
+    store = build(rescore_factor=args.rescore_factor, **setting)
+    rows, latency = search(store)
+    recall = np.mean(
+        [len(set(a) & set(b)) / args.topk for a, b in zip(rows, reference)]
+    )
+    results.append(
+        {
+            **setting,
+            "memory_usage": store.memory_usage(),
+            # the float32 copy of rescore, on disk next to the quantized matrix in memory
+            "rescore_usage": store.rescore_usage(),
+            f"recall@{args.topk}": float(recall),
+            "latency_ms": 1000 * latency,
+        }
+    )
+
+float32_usage = results[0]["memory_usage"]
+print(
+    f"{'setting':<24}{'memory MB':>12}{'disk MB':>10}{'saved':>8}{'recall':>8}{'ms':>10}"
+)
+for result in results:
+    name = result["dtype"] + (" + rescore" if result.get("rescore") else "")
+    print(
+        f"{name:<24}{result['memory_usage'] / 2**20:>12.1f}"
+        f"{result['rescore_usage'] / 2**20:>10.1f}"
+        f"{1 - result['memory_usage'] / float32_usage:>8.0%}"
+        f"{result[f'recall@{args.topk}']:>8.3f}{result['latency_ms']:>10.1f}"
+    )
+
+if args.save_path:
+    os.makedirs(os.path.dirname(args.save_path) or ".", exist_ok=True)
+    with open(args.save_path, "w") as f:
+        json.dump(results, f, indent=2)
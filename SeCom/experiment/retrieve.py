@@ -22,6 +22,11 @@ parser.add_argument(
 parser.add_argument(
     "--save_path", default="result/mtbp/retrieval/bm25/segment-k1_mtbp.jsonl"
 )
+parser.add_argument(
+    "--embedding_cache_dir",
+    default="result/cache/embeddings",
+    help="embedding cache shared by runs and granularities, empty to disable",
+)
 
 args = parser.parse_args()
 os.makedirs(os.path.dirname(args.save_path), exist_ok=True)
@@ -46,6 +51,8 @@ data = load_data(args.load_path)
 print(f"number of data: {len(data)}")
 
 secom = SeCom(config_path=args.secom_config_path)
+if args.embedding_cache_dir and secom.config.retriever.get("embedding_model"):
+    secom.config.retriever.embedding_cache_dir = args.embedding_cache_dir
 
 results = []
 processed_ids = set()
@@ -7,11 +7,22 @@ import os
 
 from tqdm import tqdm
 
-from secom import SeCom
+from secom import SeCom, llm_metrics
 
 parser = argparse.ArgumentParser(description="segment any conversation.")
 parser.add_argument("--save_path", default="result/mtbp/gpt4seg_mtbp.jsonl")
 parser.add_argument("--load_path", default="data/mtbp/mtbp.jsonl")
+parser.add_argument(
+    "--max_workers",
+    type=int,
+    default=None,
+    help="number of sessions segmented concurrently, default to the config value",
+)
+parser.add_argument(
+    "--llm_metrics_path",
+    default="",
+    help="json file of the token usage and latency of the segmentation calls, default to metrics/llm_<save file>",
+)
 args = parser.parse_args()
 os.makedirs(os.path.dirname(args.save_path), exist_ok=True)
 
@@ -52,8 +63,17 @@ for idx, sample in enumerate(tqdm(data)):
         continue
     conversation = sample["sessions"]
     print(f"segmenting {idx}-th conversation")
-    sample["segments"] = secom.segment(conversation)
+    sample["segments"] = secom.segment(conversation, max_workers=args.max_workers)
     results.append(sample)
 
     with open(args.save_path, "w", encoding="utf-8") as f:
         f.writelines([json.dumps(_, ensure_ascii=False) + "\n" for _ in results])
+
+llm_metrics.dump(
+    args.llm_metrics_path
+    or os.path.join(
+        os.path.dirname(args.save_path),
+        "metrics",
+        "llm_" + os.path.basename(args.save_path),
+    )
+)
@@ -0,0 +1,102 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from secom import SeCom
+
+parser = argparse.ArgumentParser(
+    description="measure import time and cold start of a BM25 worker."
+)
+parser.add_argument(
+    "--secom_config_path",
+    default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "../secom/configs/bm25.yaml"
+    ),
+)
+parser.add_argument(
+    "--import_budget", type=float, default=0.5, help="seconds for `import secom`"
+)
+parser.add_argument(
+    "--cold_start_budget",
+    type=float,
+    default=1.0,
+    help="seconds for `SeCom.load` and the first `get_memory`",
+)
+parser.add_argument("--n_repeat", type=int, default=5)
+args = parser.parse_args()
+
+HEAVY_MODULES = [
+    "torch",
+    "llmlingua",
+    "langchain_community",
+    "sentence_transformers",
+    "tiktoken",
+    "openai",
+]
+
+# Every measurement runs in a fresh interpreter, so that nothing is imported or loaded beforehand.
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+from secom import SeCom
+import_time = time.perf_counter() - start
+memory_manager = SeCom.load({snapshot!r})
+memory_manager.get_memory(["What is the name of my dog?"], retrieve_topk=1)
+cold_start_time = time.perf_counter() - start
+print(json.dumps({{
+    "import_time": import_time,
+    "cold_start_time": cold_start_time,
+    "heavy_modules": [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+conversation_history = [
+    [
+        "[human]: I adopted a dog last week. [bot]: Congratulations! What is its name?",
+        "[human]: His name is Rex. [bot]: Rex is a great name.",
+    ],
+    ["[human]: I am planning a trip to Hanoi. [bot]: When are you leaving?"],
+]
+
+with tempfile.TemporaryDirectory() as snapshot:
+    memory_manager = SeCom(granularity="session", config_path=args.secom_config_path)
+    memory_manager.build_memory(conversation_history, compress_rate=1.0)
+    memory_manager.init_retriever(1, **memory_manager.config.retriever)
+    memory_manager.save(snapshot)
+
+    runs = []
+    for _ in range(args.n_repeat):
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                MEASURE.format(snapshot=snapshot, heavy=HEAVY_MODULES),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+metrics = {
+    "import_time": min(run["import_time"] for run in runs),
+    "cold_start_time": min(run["cold_start_time"] for run in runs),
+    "heavy_modules": sorted({m for run in runs for m in run["heavy_modules"]}),
+}
+print(metrics)
+
+failures = []
+if metrics["import_time"] > args.import_budget:
+    failures.append(f"import took {metrics['import_time']:.3f}s")
+if metrics["cold_start_time"] > args.cold_start_budget:
+    failures.append(f"cold start took {metrics['cold_start_time']:.3f}s")
+if metrics["heavy_modules"]:
+    failures.append(f"heavy modules imported: {metrics['heavy_modules']}")
+if failures:
+    sys.exit("startup budget exceeded: " + "; ".join(failures))
@@ -5,11 +5,13 @@ import os
 import os.path as osp
 import re
 from datetime import datetime
-from time import sleep
+from time import monotonic, sleep
 
 from dotenv import load_dotenv
 from vllm import LLM, SamplingParams
 
+from secom import llm_metrics
+
 
 class OpenAILLM:
     def __init__(self, model_name="gpt-4o-mini-2024-07-18"):
@@ -92,6 +94,7 @@ class OpenAILLM:
 
 class LocalLLM:
     def __init__(self, model_name_or_path):
+        self.model_name = model_name_or_path
         self.model = LLM(model=model_name_or_path)
 
     def __call__(
@@ -107,5 +110,12 @@ class LocalLLM:
         sampling_params = SamplingParams(
             temperature=temperature, top_p=top_p, max_tokens=max_tokens, seed=seed
         )
+        start = monotonic()
         outputs = self.model.generate(prompt, sampling_params)
+        llm_metrics.record_call(
+            self.model_name,
+            monotonic() - start,
+            len(outputs[0].prompt_token_ids or []),
+            len(outputs[0].outputs[0].token_ids),
+        )
         return outputs[0].outputs[0].text
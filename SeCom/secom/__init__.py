@@ -1,7 +1,17 @@
 # Copyright (c) 2024 Microsoft
 # Licensed under The MIT License [see LICENSE for details]
 
+from .manager import MemoryManager
+from .registry import ModelRegistry, registry
 from .secom import SeCom
+from .telemetry import LLMMetrics, llm_metrics
 from .version import VERSION as __version__
 
-__all__ = ["SeCom"]
+__all__ = [
+    "SeCom",
+    "MemoryManager",
+    "ModelRegistry",
+    "registry",
+    "LLMMetrics",
+    "llm_metrics",
+]
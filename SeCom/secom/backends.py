@@ -0,0 +1,82 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+from typing import Callable, Dict, List
+
+# Retriever backends by the `storage` name used in the retriever config. Every entry is a loader returning the
+# backend class, so that a backend's dependencies are only imported when it is selected.
+STORAGE_BACKENDS: Dict[str, Callable[[], type]] = {}
+
+
+def register_storage(
+    name: str,
+    loader: Callable[[], type],
+):
+    """
+    Register a retriever backend under a `storage` name.
+
+    Dense backends are built with `from_documents(documents, embeddings, ids=...)` and used via `as_retriever`,
+        sparse backends with `from_documents(documents, k=topk)`. A backend may implement `add_documents` and
+        `replace_document(idx, doc)` to be updated incrementally, and `save_local`/`load_local` to be saved.
+
+    Args:
+        name (str): The `storage` value of the retriever config.
+        loader (Callable[[], type]): Returns the backend class, called each time the backend is built.
+    """
+    STORAGE_BACKENDS[name] = loader
+
+
+def get_storage_class(storage: str) -> type:
+    if storage not in STORAGE_BACKENDS:
+        raise ValueError(
+            f"unknown storage {storage}, expected one of {available_storages()}"
+        )
+    return STORAGE_BACKENDS[storage]()
+
+
+def available_storages() -> List[str]:
+    return sorted(STORAGE_BACKENDS)
+
+
+def _bm25_index():
+    from .bm25 import BM25Index
+
+    return BM25Index
+
+
+def _flat_vector_store():
+    from .vectorstore import FlatVectorStore
+
+    return FlatVectorStore
+
+
+def _hybrid_store():
+    from .hybrid import HybridStore
+
+    return HybridStore
+
+
+def _bm25_retriever():
+    from langchain_community.retrievers import BM25Retriever
+
+    return BM25Retriever
+
+
+def _faiss():
+    from langchain_community.vectorstores import FAISS
+
+    return FAISS
+
+
+def _chroma():
+    from langchain_community.vectorstores import Chroma
+
+    return Chroma
+
+
+register_storage("BM25Index", _bm25_index)
+register_storage("FlatVectorStore", _flat_vector_store)
+register_storage("Hybrid", _hybrid_store)
+register_storage("BM25Retriever", _bm25_retriever)
+register_storage("FAISS", _faiss)
+register_storage("Chroma", _chroma)
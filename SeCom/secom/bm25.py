@@ -0,0 +1,191 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import heapq
+import math
+from collections import Counter
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple
+
+if TYPE_CHECKING:
+    from langchain_core.documents import Document
+
+
+def default_preprocessing_func(text: str) -> List[str]:
+    return text.split()
+
+
+class BM25Index:
+    """
+    Okapi BM25 retriever over an incrementally maintained inverted index.
+
+    Scores are the same as `rank_bm25.BM25Okapi`, which backs langchain's `BM25Retriever`, but documents can be
+        appended or replaced without rebuilding the corpus statistics, and a query only visits the postings of its
+        own terms instead of scoring every document.
+
+    Args:
+        k (int, optional): The number of documents to retrieve. Default is 3.
+        k1 (float, optional): BM25 term frequency saturation. Default is 1.5.
+        b (float, optional): BM25 document length normalization. Default is 0.75.
+        epsilon (float, optional): Floor for negative idf, as a fraction of the average idf. Default is 0.25.
+        preprocess_func (Callable, optional): Tokenizer applied to documents and queries. Default splits on whitespace.
+    """
+
+    def __init__(
+        self,
+        k: int = 3,
+        k1: float = 1.5,
+        b: float = 0.75,
+        epsilon: float = 0.25,
+        preprocess_func: Callable[[str], List[str]] = default_preprocessing_func,
+    ):
+        self.k = k
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.preprocess_func = preprocess_func
+
+        self.docs = []
+        self.doc_freqs = []
+        self.doc_len = []
+        self.total_len = 0
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self._average_idf = None
+
+    @classmethod
+    def from_documents(
+        cls,
+        documents: List["Document"],
+        k: int = 3,
+        **kwargs,
+    ):
+        index = cls(k=k, **kwargs)
+        index.add_documents(documents)
+        return index
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add_documents(
+        self,
+        documents: List["Document"],
+    ):
+        for doc in documents:
+            self.docs.append(doc)
+            self.doc_freqs.append(Counter())
+            self.doc_len.append(0)
+            self._index(len(self.docs) - 1, doc)
+        self._average_idf = None
+
+    def replace_document(
+        self,
+        idx: int,
+        document: "Document",
+    ):
+        """
+        Replace the document at `idx` in place, e.g. when the last memory unit is extended with a new turn.
+        """
+        idx = idx % len(self.docs)
+        for term in self.doc_freqs[idx]:
+            postings = self.postings[term]
+            del postings[idx]
+            if not postings:
+                del self.postings[term]
+        self.total_len -= self.doc_len[idx]
+
+        self.docs[idx] = document
+        self._index(idx, document)
+        self._average_idf = None
+
+    def memory_usage(self):
+        """
+        Estimate the bytes held by the postings and per-document term counts, excluding the documents themselves.
+        """
+        n_postings = sum(len(postings) for postings in self.postings.values())
+        n_terms = sum(len(freqs) for freqs in self.doc_freqs)
+        # rough CPython costs of a dict entry with a small int value, plus the term string keys
+        return 100 * (n_postings + n_terms) + 60 * len(self.postings)
+
+    def _index(self, idx, doc):
+        freqs = Counter(self.preprocess_func(doc.page_content))
+        for term, freq in freqs.items():
+            self.postings.setdefault(term, {})[idx] = freq
+        self.doc_freqs[idx] = freqs
+        self.doc_len[idx] = sum(freqs.values())
+        self.total_len += self.doc_len[idx]
+
+    def _raw_idf(self, df):
+        return math.log(len(self.docs) - df + 0.5) - math.log(df + 0.5)
+
+    @property
+    def average_idf(self):
+        # Only invalidated by mutations, so repeated queries over an unchanged index do not touch the vocabulary.
+        if self._average_idf is None:
+            idf_sum = sum(self._raw_idf(len(p)) for p in self.postings.values())
+            self._average_idf = idf_sum / max(len(self.postings), 1)
+        return self._average_idf
+
+    def idf(self, term):
+        postings = self.postings.get(term)
+        if not postings:
+            return 0.0
+        idf = self._raw_idf(len(postings))
+        if idf < 0:
+            idf = self.epsilon * self.average_idf
+        return idf
+
+    def get_scores(
+        self,
+        query: str,
+    ) -> Dict[int, float]:
+        """
+        Score the documents sharing at least one term with the query, all other documents score 0.
+        """
+        scores = {}
+        if not self.docs:
+            return scores
+        avgdl = self.total_len / len(self.docs)
+        for term in self.preprocess_func(query):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term)
+            for idx, freq in postings.items():
+                denom = freq + self.k1 * (
+                    1 - self.b + self.b * self.doc_len[idx] / avgdl
+                )
+                scores[idx] = scores.get(idx, 0.0) + idf * freq * (self.k1 + 1) / denom
+        return scores
+
+    def invoke(
+        self,
+        query: str,
+    ) -> List["Document"]:
+        return [self.docs[idx] for idx, _ in self.search(query, self.k)]
+
+    def search(
+        self,
+        query: str,
+        k: int,
+    ) -> List[Tuple[int, float]]:
+        """
+        Return the (index, score) pairs of the top-k documents, best first.
+        """
+        scores = self.get_scores(query)
+        k = min(k, len(self.docs))
+        candidates = list(scores)
+        # Unmatched documents all score 0 and are ranked by index like `BM25Okapi.get_top_n`.
+        idx = len(self.docs) - 1
+        n_pad = 0
+        while n_pad < k and idx >= 0:
+            if idx not in scores:
+                candidates.append(idx)
+                n_pad += 1
+            idx -= 1
+        top = heapq.nlargest(k, candidates, key=lambda i: (scores.get(i, 0.0), i))
+        return [(i, scores.get(i, 0.0)) for i in top]
+
+    def batch_invoke(
+        self,
+        queries: List[str],
+    ) -> List[List["Document"]]:
+        return [self.invoke(query) for query in queries]
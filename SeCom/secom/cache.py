@@ -0,0 +1,186 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class SQLiteCache:
+    """
+    Disk-backed key-value cache on a SQLite file, with time-to-live expiry and least-recently-used eviction.
+
+    Values are stored as JSON, so any JSON-serializable value can be cached. The file can be shared by several
+        processes, e.g. experiment scripts running different granularities at the same time.
+
+    Args:
+        path (str): The SQLite file, created together with its directory if it does not exist.
+        max_entries (int, optional): The maximum number of entries, least recently used entries are evicted beyond it.
+            Default is None, unbounded.
+        ttl (float, optional): The number of seconds an entry stays valid after it is written. Default is None, forever.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._migrate()
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+        )
+        self._conn.commit()
+
+    def _migrate(self):
+        # caches written before entries expired have no `created` column, their entries count from the last access
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(cache)")}
+        if "created" in columns:
+            return
+        try:
+            self._conn.execute(
+                "ALTER TABLE cache ADD COLUMN created REAL NOT NULL DEFAULT 0"
+            )
+        except sqlite3.OperationalError as e:
+            # another process sharing the file migrated it first
+            if "duplicate column" not in str(e):
+                raise
+            return
+        self._conn.execute("UPDATE cache SET created = accessed")
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key: str):
+        return self.get_many([key]).get(key)
+
+    def set(self, key: str, value):
+        self.set_many({key: value})
+
+    def get_many(
+        self,
+        keys: List[str],
+    ) -> Dict[str, object]:
+        """
+        Look up many keys at once, return the cached values of the keys that are present.
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        expire_before = now - self.ttl if self.ttl is not None else float("-inf")
+        with self._lock:
+            # stay well below SQLite's limit on the number of bound parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                rows = self._conn.execute(
+                    "SELECT key, value FROM cache "
+                    f"WHERE key IN ({','.join('?' * len(chunk))}) AND created >= ?",
+                    chunk + [expire_before],
+                ).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+            if found:
+                self._conn.executemany(
+                    "UPDATE cache SET accessed = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(
+        self,
+        items: Dict[str, object],
+    ):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (key, json.dumps(value, ensure_ascii=False), now, now)
+                    for key, value in items.items()
+                ],
+            )
+            if self.ttl is not None:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE created < ?", (now - self.ttl,)
+                )
+            if self.max_entries is not None:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        n_entries = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if n_entries > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY accessed LIMIT ?)",
+                (n_entries - self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+
+class CompressionCache(SQLiteCache):
+    """
+    Content-addressed cache of LLMLingua-2 compressed exchanges.
+
+    Entries are keyed by the hash of (exchange text, compressor model, rate, force_tokens), so an exchange that
+        appears in several memory units, granularities or runs is only compressed once.
+    """
+
+    def make_compression_key(
+        self,
+        text: str,
+        compress_model: str,
+        rate: float,
+        force_tokens: List[str],
+    ) -> str:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return self.make_key(text_hash, compress_model, rate, list(force_tokens))
+
+
+class LLMResponseCache(SQLiteCache):
+    """
+    Cache of chat completion responses, keyed by the canonical hash of the request.
+
+    The key covers every field sent to the endpoint (model, messages, temperature, top_p, max_tokens, seed and any
+        extra body), so a cached response is only reused for an identical request.
+    """
+
+    def make_request_key(
+        self,
+        request: Dict[str, object],
+    ) -> str:
+        return self.make_key(request)
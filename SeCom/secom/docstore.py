@@ -0,0 +1,134 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import json
+import mmap
+import os
+import sys
+from typing import TYPE_CHECKING, Iterable
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from langchain_core.documents import Document
+
+
+def save_array(path: str, array):
+    """
+    `np.save` through a temporary file, so that a process still mapping the old file keeps reading valid data.
+    """
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+class MappedDocumentStore:
+    """
+    Read-mostly sequence of `Document` stored as one blob of JSON records and an offset index.
+
+    Records are decoded from a read-only memory map on access, so opening a store costs the same for any number of
+        documents, and processes opening the same files share one page-cached copy. Documents replaced or appended
+        after opening are kept in memory until the store is written again.
+
+    The files are `{path}.bin`, the concatenated UTF-8 JSON records, and `{path}.offsets.npy`, the int64 start of
+        every record followed by the end of the blob.
+
+    Args:
+        path (str): The path of the store, without suffix.
+    """
+
+    def __init__(
+        self,
+        path: str,
+    ):
+        from langchain_core.documents import Document
+
+        self._document_class = Document
+        self.path = path
+        self._offsets = np.load(path + ".offsets.npy", mmap_mode="r")
+        self._blob = b""
+        with open(path + ".bin", "rb") as f:
+            if self._offsets[-1] > 0:
+                self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._n_mapped = len(self._offsets) - 1
+        self._replaced = {}
+        self._appended = []
+
+    @staticmethod
+    def write(
+        path: str,
+        documents: Iterable["Document"],
+    ):
+        """
+        Write documents in the format read by `MappedDocumentStore(path)`.
+        """
+        offsets = [0]
+        tmp_path = path + ".bin.tmp"
+        with open(tmp_path, "wb") as f:
+            for doc in documents:
+                record = {"page_content": doc.page_content, "metadata": doc.metadata}
+                offsets.append(
+                    offsets[-1]
+                    + f.write(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+                )
+        os.replace(tmp_path, path + ".bin")
+        save_array(path + ".offsets.npy", np.asarray(offsets, dtype=np.int64))
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path + ".offsets.npy")
+
+    def __len__(self):
+        return self._n_mapped + len(self._appended)
+
+    def _index(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("document index out of range")
+        return idx
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        idx = self._index(idx)
+        if idx >= self._n_mapped:
+            return self._appended[idx - self._n_mapped]
+        if idx in self._replaced:
+            return self._replaced[idx]
+        record = json.loads(self._blob[self._offsets[idx] : self._offsets[idx + 1]])
+        return self._document_class(**record)
+
+    def __setitem__(self, idx, doc: "Document"):
+        idx = self._index(idx)
+        if idx >= self._n_mapped:
+            self._appended[idx - self._n_mapped] = doc
+        else:
+            self._replaced[idx] = doc
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def append(self, doc: "Document"):
+        self._appended.append(doc)
+
+    def extend(self, documents: Iterable["Document"]):
+        self._appended.extend(documents)
+
+    def clear(self):
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._blob = b""
+        self._n_mapped = 0
+        self._replaced = {}
+        self._appended = []
+
+    def memory_usage(self) -> int:
+        # mapped records live in the page cache, only the documents changed since opening are on the heap
+        n_bytes = 0
+        for doc in list(self._replaced.values()) + self._appended:
+            n_bytes += sys.getsizeof(doc.page_content)
+            content = doc.metadata.get("content", [])
+            for text in content if isinstance(content, list) else [content]:
+                n_bytes += sys.getsizeof(text)
+        return n_bytes
@@ -0,0 +1,188 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class EmbeddingCache:
+    """
+    Disk-backed cache of the embedding vectors of one embedding model.
+
+    Vectors are appended to a flat `vectors.bin` matrix that is read through a numpy memory map, and a SQLite
+        index maps the text hash to its row. Appends take a file lock, so several processes can share one cache.
+
+    Nothing is ever evicted: the cache grows by one row per distinct text (memory units and queries alike) and
+        is meant to be cleared by deleting `cache_dir` when it gets too large.
+
+    Args:
+        cache_dir (str): The root directory of embedding caches, every model gets its own sub-directory.
+        model_name (str): The name of the embedding model, part of the cache key.
+        dtype (str, optional): The storage dtype of the vectors, "float32" or "float16". Default is "float32".
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        model_name: str,
+        dtype: str = "float32",
+    ):
+        assert dtype in ("float32", "float16"), f"unsupported dtype {dtype}"
+        self.model_name = model_name
+        self.dtype = np.dtype(dtype)
+        self.dir = os.path.join(
+            os.path.expanduser(cache_dir), model_name.replace("/", "__"), dtype
+        )
+        os.makedirs(self.dir, exist_ok=True)
+        self.vectors_path = os.path.join(self.dir, "vectors.bin")
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        self.lock_path = os.path.join(self.dir, "lock")
+        self.dim = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+        self.hits = 0
+        self.misses = 0
+        self._vectors = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(self.dir, "index.sqlite"), timeout=30, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rows (key TEXT PRIMARY KEY, row INTEGER NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_text_key(text: str, kind: str = "document") -> str:
+        return hashlib.sha256(f"{kind}\0{text}".encode("utf-8")).hexdigest()
+
+    def _mapped(self, n_rows):
+        # remap only when another call or process has appended rows beyond the current mapping
+        if self._vectors is None or len(self._vectors) < n_rows:
+            n_total = os.path.getsize(self.vectors_path) // (
+                self.dim * self.dtype.itemsize
+            )
+            self._vectors = np.memmap(
+                self.vectors_path, dtype=self.dtype, mode="r", shape=(n_total, self.dim)
+            )
+        return self._vectors
+
+    def get_many(
+        self,
+        keys: List[str],
+    ):
+        """
+        Look up many text keys at once, return a dict from the present keys to their float32 vectors.
+        """
+        keys = list(dict.fromkeys(keys))
+        with self._lock:
+            rows = {}
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                rows.update(
+                    self._conn.execute(
+                        f"SELECT key, row FROM rows WHERE key IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    ).fetchall()
+                )
+            found = {}
+            if rows:
+                vectors = self._mapped(max(rows.values()) + 1)
+                found = {
+                    key: np.asarray(vectors[row], dtype=np.float32)
+                    for key, row in rows.items()
+                }
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def add_many(
+        self,
+        keys: List[str],
+        vectors,
+    ):
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+        with self._lock, open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.dim is None:
+                if os.path.exists(self.meta_path):
+                    with open(self.meta_path, "r", encoding="utf-8") as f:
+                        self.dim = json.load(f)["dim"]
+                else:
+                    self.dim = vectors.shape[1]
+                    with open(self.meta_path, "w", encoding="utf-8") as f:
+                        json.dump({"model_name": self.model_name, "dim": self.dim}, f)
+            assert vectors.shape[1] == self.dim, "embedding dimension changed"
+            with open(self.vectors_path, "ab") as f:
+                first_row = f.tell() // (self.dim * self.dtype.itemsize)
+                f.write(vectors.tobytes())
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO rows (key, row) VALUES (?, ?)",
+                [(key, first_row + i) for i, key in enumerate(keys)],
+            )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    langchain `Embeddings` wrapper that serves vectors from an `EmbeddingCache` and only embeds unseen texts.
+
+    Args:
+        embeddings (Embeddings): The underlying embedding model, e.g. `HuggingFaceEmbeddings`.
+        cache (EmbeddingCache): The cache of the same embedding model.
+    """
+
+    def __init__(self, embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def _embed(self, texts, kind, embed_func):
+        keys = [self.cache.make_text_key(text, kind) for text in texts]
+        found = self.cache.get_many(keys)
+        todo = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                todo[key] = text
+        if todo:
+            vectors = np.asarray(embed_func(list(todo.values())), dtype=np.float32)
+            self.cache.add_many(list(todo), vectors)
+            # round-trip through the storage dtype, so a text gets the same vector whether it was cached or not
+            vectors = vectors.astype(self.cache.dtype).astype(np.float32)
+            found.update(zip(todo, vectors))
+        return [found[key].tolist() for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, "document", self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(
+            texts,
+            "query",
+            lambda texts: embed_queries(self.embeddings, texts),
+        )
+
+
+def embed_queries(embeddings, texts: List[str]) -> List[List[float]]:
+    """
+    Embed a batch of queries with the query encoding of `embeddings`, which differs from the document encoding
+        for asymmetric models.
+    """
+    if hasattr(embeddings, "embed_queries"):
+        return embeddings.embed_queries(texts)
+    return [embeddings.embed_query(text) for text in texts]
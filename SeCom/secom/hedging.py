@@ -0,0 +1,220 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import functools
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
+from typing import Callable, Dict, Optional
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    # one pool for the hedged sync requests of the process
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=64, thread_name_prefix="secom-hedge"
+            )
+        return _executor
+
+
+class Hedger:
+    """
+    Hedged requests: if a request has not returned by the `quantile` of recent latencies, an identical request is
+        sent and whichever returns first is used.
+
+    Latencies are tracked per size bucket of the request (the bit length of its prompt length), since a long
+        segmentation prompt takes longer than an incremental one. A bucket hedges once it has `min_samples`
+        latencies. The losing request is cancelled (async) or left to finish in the background (sync); it is
+        counted in `stats`, with its estimated tokens as the extra cost and, given `usage`, the tokens it actually
+        used once it finishes. A hedge doubles the load of a request, so the caller can withhold it with `admit`,
+        e.g. while the concurrency limit of the endpoint is reached.
+
+    Args:
+        quantile (float, optional): The latency quantile after which a request is hedged. Default is 0.95.
+        min_samples (int, optional): The number of latencies of a bucket before it hedges. Default is 20.
+        window (int, optional): The number of recent latencies kept per bucket. Default is 500.
+        min_delay (float, optional): The minimum seconds before hedging. Default is 0.
+    """
+
+    def __init__(
+        self,
+        quantile: float = 0.95,
+        min_samples: int = 20,
+        window: int = 500,
+        min_delay: float = 0.0,
+    ):
+        assert 0 < quantile < 1, "quantile out of (0, 1)"
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.window = window
+        self.min_delay = min_delay
+        self.counts = Counter()
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def bucket(size: int) -> int:
+        return int(size).bit_length()
+
+    def record(self, bucket: int, seconds: float):
+        with self._lock:
+            if bucket not in self._latencies:
+                self._latencies[bucket] = deque(maxlen=self.window)
+            self._latencies[bucket].append(seconds)
+
+    def delay(self, bucket: int) -> Optional[float]:
+        """
+        The seconds after which a request of `bucket` is hedged, None if the bucket has too few latencies.
+        """
+        with self._lock:
+            latencies = self._latencies.get(bucket)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            latencies = sorted(latencies)
+        idx = min(len(latencies) - 1, int(self.quantile * len(latencies)))
+        return max(self.min_delay, latencies[idx])
+
+    def _count(self, **counts):
+        with self._lock:
+            self.counts.update(counts)
+
+    def run(
+        self,
+        fn: Callable,
+        *args,
+        size: int = 0,
+        cost: int = 0,
+        admit: Optional[Callable[[], bool]] = None,
+        usage: Optional[Callable[[object], Optional[int]]] = None,
+    ):
+        """
+        Call `fn(*args)` and hedge it, `size` the size of the request and `cost` its estimated tokens.
+
+        `admit()` is asked before a hedge is sent, which is skipped if it returns False. `usage(result)` gives the
+            tokens used by a request, counted for the losing one.
+        """
+        self._count(requests=1)
+        bucket = self.bucket(size)
+        delay = self.delay(bucket)
+        if delay is None:
+            return self._timed(bucket, fn, *args)
+        primary = get_executor().submit(self._timed, bucket, fn, *args)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        if admit is not None and not admit():
+            self._count(skipped=1)
+            return primary.result()
+        self._count(hedged=1, hedged_tokens=cost)
+        hedge = get_executor().submit(self._timed, bucket, fn, *args)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count(hedge_wins=1)
+                    if usage is not None:
+                        # the loser runs on, its tokens are counted when it returns
+                        loser = primary if future is hedge else hedge
+                        loser.add_done_callback(
+                            functools.partial(self._count_loser, usage)
+                        )
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    async def arun(
+        self,
+        fn: Callable,
+        *args,
+        size: int = 0,
+        cost: int = 0,
+        admit: Optional[Callable[[], bool]] = None,
+        usage: Optional[Callable[[object], Optional[int]]] = None,
+    ):
+        """
+        Await `fn(*args)` and hedge it, with the arguments of `run`.
+        """
+        import asyncio
+
+        self._count(requests=1)
+        bucket = self.bucket(size)
+        delay = self.delay(bucket)
+        if delay is None:
+            return await self._atimed(bucket, fn, *args)
+        primary = asyncio.ensure_future(self._atimed(bucket, fn, *args))
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                return primary.result()
+            if admit is not None and not admit():
+                self._count(skipped=1)
+                return await primary
+            self._count(hedged=1, hedged_tokens=cost)
+            hedge = asyncio.ensure_future(self._atimed(bucket, fn, *args))
+            pending = {primary, hedge}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._count(hedge_wins=1)
+                        if usage is not None:
+                            # a loser that returned at the same time has used its tokens
+                            loser = primary if task is hedge else hedge
+                            loser.add_done_callback(
+                                functools.partial(self._count_loser, usage)
+                            )
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def _count_loser(self, usage, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        self._count(loser_tokens=usage(future.result()) or 0)
+
+    def _timed(self, bucket, fn, *args):
+        start = time.monotonic()
+        result = fn(*args)
+        self.record(bucket, time.monotonic() - start)
+        return result
+
+    async def _atimed(self, bucket, fn, *args):
+        start = time.monotonic()
+        result = await fn(*args)
+        self.record(bucket, time.monotonic() - start)
+        return result
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                name: self.counts[name]
+                for name in (
+                    "requests",
+                    "hedged",
+                    "hedge_wins",
+                    "skipped",
+                    "hedged_tokens",
+                    "loser_tokens",
+                )
+            }
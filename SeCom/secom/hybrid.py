@@ -0,0 +1,246 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import heapq
+import json
+import os
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+from .bm25 import BM25Index
+from .vectorstore import FlatRetriever, FlatVectorStore
+
+if TYPE_CHECKING:
+    from langchain_core.documents import Document
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    # one pool for all hybrid stores of the process, e.g. the memory banks of every tenant
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 4, thread_name_prefix="secom-dense"
+            )
+        return _executor
+
+
+class HybridStore:
+    """
+    Hybrid retriever over one memory bank, fusing the rankings of a dense `FlatVectorStore` and a `BM25Index`.
+
+    Both indexes hold the memory units in the same order, so a memory unit is identified by its position. The dense
+        search of a batch of requests (one embedding batch and one matrix product) runs in a worker thread while
+        BM25 scores the same batch, so the latency stays close to the slower of the two rather than their sum. Each
+        side returns `candidate_factor * k` candidates, which are fused with reciprocal rank fusion ("rrf") or a
+        weighted sum of min-max normalized scores ("weighted").
+
+    Args:
+        dense (FlatVectorStore): The dense index.
+        sparse (BM25Index): The BM25 index over the same memory units.
+        fusion (str, optional): "rrf" or "weighted". Default is "rrf".
+        dense_weight (float, optional): The weight of the dense ranking, BM25 gets 1 - dense_weight. Default is 0.5.
+        rrf_k (int, optional): The rank offset of reciprocal rank fusion. Default is 60.
+        candidate_factor (int, optional): The number of candidates per side and retrieved memory unit. Default is 2.
+    """
+
+    def __init__(
+        self,
+        dense: FlatVectorStore,
+        sparse: BM25Index,
+        fusion: str = "rrf",
+        dense_weight: float = 0.5,
+        rrf_k: int = 60,
+        candidate_factor: int = 2,
+    ):
+        assert fusion in ("rrf", "weighted"), f"unknown fusion {fusion}"
+        self.dense = dense
+        self.sparse = sparse
+        self.fusion = fusion
+        self.dense_weight = dense_weight
+        self.rrf_k = rrf_k
+        self.candidate_factor = candidate_factor
+
+    @classmethod
+    def from_documents(
+        cls,
+        documents: List["Document"],
+        embedding,
+        ids: Optional[List] = None,
+        dense_kwargs: Optional[dict] = None,
+        sparse_kwargs: Optional[dict] = None,
+        **kwargs,
+    ):
+        """
+        Build both indexes. `dense_kwargs` and `sparse_kwargs` are passed to `FlatVectorStore` and `BM25Index`.
+        """
+        documents = list(documents)
+        dense = FlatVectorStore.from_documents(
+            documents, embedding, ids=ids, **(dense_kwargs or {})
+        )
+        sparse = BM25Index.from_documents(documents, **(sparse_kwargs or {}))
+        return cls(dense, sparse, **kwargs)
+
+    def __len__(self):
+        return len(self.dense)
+
+    def add_documents(
+        self,
+        documents: List["Document"],
+        ids: Optional[List] = None,
+    ) -> List:
+        self.sparse.add_documents(documents)
+        return self.dense.add_documents(documents, ids=ids)
+
+    def replace_document(
+        self,
+        idx: int,
+        doc: "Document",
+    ):
+        self.sparse.replace_document(idx, doc)
+        self.dense.replace_document(idx, doc)
+
+    def update_documents(
+        self,
+        start: int,
+        documents: List["Document"],
+    ):
+        # the dense side embeds first, BM25 is only updated once that succeeded
+        self.dense.update_documents(start, documents)
+        n_replaced = max(0, min(len(documents), len(self.sparse.docs) - start))
+        for i, doc in enumerate(documents[:n_replaced]):
+            self.sparse.replace_document(start + i, doc)
+        self.sparse.add_documents(documents[n_replaced:])
+
+    def _dense_search(self, queries, k):
+        from .embeddings import embed_queries
+
+        rows, scores = self.dense.search_by_vectors(
+            embed_queries(self.dense.embedding, queries), k
+        )
+        return [
+            list(zip(row.tolist(), score.tolist())) for row, score in zip(rows, scores)
+        ]
+
+    def fuse(
+        self,
+        dense: List[Tuple[int, float]],
+        sparse: List[Tuple[int, float]],
+        k: int,
+    ) -> List[int]:
+        """
+        Fuse two (index, score) rankings, best first, and return the indexes of the top-k memory units.
+        """
+        fused = {}
+        for ranking, weight in (
+            (dense, self.dense_weight),
+            (sparse, 1 - self.dense_weight),
+        ):
+            if not ranking:
+                continue
+            if self.fusion == "rrf":
+                for rank, (idx, _) in enumerate(ranking):
+                    fused[idx] = fused.get(idx, 0.0) + weight / (self.rrf_k + rank + 1)
+            else:
+                low = min(score for _, score in ranking)
+                high = max(score for _, score in ranking)
+                for idx, score in ranking:
+                    normalized = (score - low) / (high - low) if high > low else 1.0
+                    fused[idx] = fused.get(idx, 0.0) + weight * normalized
+        return heapq.nlargest(k, fused, key=fused.get)
+
+    def batch_search(
+        self,
+        queries: List[str],
+        k: int,
+    ) -> List[List["Document"]]:
+        if not queries:
+            return []
+        n_candidates = k * self.candidate_factor
+        dense_future = get_executor().submit(self._dense_search, queries, n_candidates)
+        # documents that share no term with the request score 0 and carry no BM25 evidence
+        sparse_results = [
+            [
+                (idx, score)
+                for idx, score in self.sparse.search(q, n_candidates)
+                if score > 0
+            ]
+            for q in queries
+        ]
+        dense_results = dense_future.result()
+        return [
+            [self.dense.docs[idx] for idx in self.fuse(dense, sparse, k)]
+            for dense, sparse in zip(dense_results, sparse_results)
+        ]
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 3,
+    ) -> List["Document"]:
+        return self.batch_search([query], k)[0]
+
+    def as_retriever(
+        self,
+        search_kwargs: Optional[dict] = None,
+    ):
+        return FlatRetriever(self, k=(search_kwargs or {}).get("k", 3))
+
+    def save_local(
+        self,
+        folder_path: str,
+    ):
+        os.makedirs(folder_path, exist_ok=True)
+        self.dense.save_local(os.path.join(folder_path, "dense"))
+        # documents are resolved through the dense store, the BM25 index is saved without its copy of them
+        docs, self.sparse.docs = self.sparse.docs, []
+        try:
+            with open(os.path.join(folder_path, "sparse.pkl.tmp"), "wb") as f:
+                pickle.dump(self.sparse, f)
+        finally:
+            self.sparse.docs = docs
+        os.replace(
+            os.path.join(folder_path, "sparse.pkl.tmp"),
+            os.path.join(folder_path, "sparse.pkl"),
+        )
+        config = {
+            "fusion": self.fusion,
+            "dense_weight": self.dense_weight,
+            "rrf_k": self.rrf_k,
+            "candidate_factor": self.candidate_factor,
+        }
+        with open(os.path.join(folder_path, "hybrid.json"), "w", encoding="utf-8") as f:
+            json.dump(config, f, indent=2)
+
+    @classmethod
+    def load_local(
+        cls,
+        folder_path: str,
+        embeddings,
+        allow_dangerous_deserialization: bool = False,
+        dense_kwargs: Optional[dict] = None,
+        sparse_kwargs: Optional[dict] = None,
+        **kwargs,
+    ):
+        """
+        Restore a store saved by `save_local`. `dense_kwargs` and `kwargs` override the saved settings, the BM25
+            index keeps its saved settings.
+        """
+        dense = FlatVectorStore.load_local(
+            os.path.join(folder_path, "dense"), embeddings, **(dense_kwargs or {})
+        )
+        with open(os.path.join(folder_path, "sparse.pkl"), "rb") as f:
+            sparse = pickle.load(f)
+        # the BM25 index only needs the number of documents
+        sparse.docs = [None] * len(dense)
+        with open(os.path.join(folder_path, "hybrid.json"), "r", encoding="utf-8") as f:
+            config = json.load(f)
+        return cls(dense, sparse, **{**config, **kwargs})
+
+    def memory_usage(self) -> int:
+        return self.dense.memory_usage() + self.sparse.memory_usage()
@@ -0,0 +1,268 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Optional
+from urllib.parse import quote
+
+from .registry import ModelRegistry
+from .registry import registry as default_registry
+from .secom import SeCom
+
+
+class MemoryManager:
+    """
+    Serve the memory banks of many tenants (e.g. users) from one process.
+
+    Every tenant gets its own SeCom memory bank and retriever index, while the compressor, embedding model and
+        tokenizer are shared through the model registry. Tenants are kept in least-recently-used order; when the
+        memory budget is exceeded, the coldest tenants are saved to `spill_dir` with `SeCom.save` and dropped,
+        and they are restored with `SeCom.load` on their next access. The memory usage of a tenant is measured
+        when it is loaded and after it changes, so checking the budget does not walk the other tenants.
+
+    Args:
+        spill_dir (str): The directory to save evicted tenants to, one snapshot per tenant.
+        granularity (str, optional): The granularity of new tenants. Default is "segment".
+        config_path (str, optional): The config of new tenants. Default config is "configs/mpnet.yaml".
+        max_tenants (int, optional): The maximum number of tenants kept in memory. Default is None, unbounded.
+        max_bytes (int, optional): The memory budget of all tenants, estimated by `SeCom.memory_usage`.
+            Default is None, unbounded.
+        registry (ModelRegistry, optional): The registry to load models from. Default is the process-wide registry.
+    Example:
+        >>> manager = MemoryManager("memory/", config_path="configs/bm25.yaml", max_bytes=2 * 1024**3)
+        >>> manager.get_memory("user_0", requests, conversation_history, retrieve_topk=3)
+        >>> manager.update_memory("user_0", "[human]: ... [bot]: ...")
+        >>> manager.get_memory("user_0", ["A question regarding the conversation history"])
+    """
+
+    def __init__(
+        self,
+        spill_dir: str,
+        granularity: str = "segment",
+        config_path: str = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "configs/mpnet.yaml"
+        ),
+        max_tenants: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        registry: ModelRegistry = None,
+    ):
+        self.spill_dir = spill_dir
+        self.granularity = granularity
+        self.config_path = config_path
+        self.max_tenants = max_tenants
+        self.max_bytes = max_bytes
+        self.registry = registry if registry is not None else default_registry
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        self.tenants = OrderedDict()
+        # tenant_id -> [lock, number of threads using it], dropped once unused and out of memory
+        self.tenant_locks = {}
+        self.tenant_bytes = {}
+        self.n_bytes = 0
+        self.n_evicted = 0
+        self.n_restored = 0
+        self._lock = threading.Lock()
+
+    def snapshot_path(self, tenant_id: str) -> str:
+        return os.path.join(self.spill_dir, quote(tenant_id, safe=""))
+
+    @contextmanager
+    def _tenant_lock(
+        self,
+        tenant_id: str,
+        blocking: bool = True,
+    ):
+        """
+        Hold the lock of a tenant, yield whether it was acquired.
+        """
+        with self._lock:
+            entry = self.tenant_locks.setdefault(tenant_id, [threading.RLock(), 0])
+            entry[1] += 1
+        acquired = entry[0].acquire(blocking=blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0 and tenant_id not in self.tenants:
+                    del self.tenant_locks[tenant_id]
+
+    def _update_usage(self, tenant_id, secom):
+        # only the tenant that changed is measured again
+        n_bytes = secom.memory_usage()
+        with self._lock:
+            if tenant_id in self.tenants:
+                self.n_bytes += n_bytes - self.tenant_bytes.get(tenant_id, 0)
+                self.tenant_bytes[tenant_id] = n_bytes
+
+    def get(
+        self,
+        tenant_id: str,
+    ) -> SeCom:
+        """
+        Return the SeCom instance of a tenant, restoring it from its snapshot or creating it if needed.
+        """
+        with self._tenant_lock(tenant_id):
+            with self._lock:
+                if tenant_id in self.tenants:
+                    self.tenants.move_to_end(tenant_id)
+                    return self.tenants[tenant_id]
+            path = self.snapshot_path(tenant_id)
+            if os.path.exists(os.path.join(path, "state.json")):
+                secom = SeCom.load(path, registry=self.registry)
+                self.n_restored += 1
+            else:
+                secom = SeCom(
+                    granularity=self.granularity,
+                    config_path=self.config_path,
+                    registry=self.registry,
+                )
+            with self._lock:
+                self.tenants[tenant_id] = secom
+            self._update_usage(tenant_id, secom)
+        self.enforce_budget(keep=tenant_id)
+        return secom
+
+    def get_memory(
+        self,
+        tenant_id: str,
+        requests: List[str],
+        conversation_history: List[List[str]] = [],
+        compress_rate: float = 0.9,
+        retrieve_topk: int = 3,
+    ):
+        """
+        `SeCom.get_memory` on the memory bank of a tenant.
+        """
+        with self._tenant_lock(tenant_id):
+            secom = self.get(tenant_id)
+            retriever = secom.retriever
+            result = secom.get_memory(
+                requests,
+                conversation_history,
+                compress_rate=compress_rate,
+                retrieve_topk=retrieve_topk,
+            )
+            if conversation_history or secom.retriever is not retriever:
+                # the memory was built from `conversation_history`, or the retriever rebuilt
+                self._update_usage(tenant_id, secom)
+        self.enforce_budget(keep=tenant_id)
+        return result
+
+    def update_memory(
+        self,
+        tenant_id: str,
+        new_turn: str,
+    ):
+        """
+        `SeCom.update_memory` on the memory bank of a tenant.
+        """
+        with self._tenant_lock(tenant_id):
+            secom = self.get(tenant_id)
+            secom.update_memory(new_turn)
+            self._update_usage(tenant_id, secom)
+        self.enforce_budget(keep=tenant_id)
+
+    def update_memory_batch(
+        self,
+        tenant_id: str,
+        new_turns: List[str],
+    ):
+        """
+        `SeCom.update_memory_batch` on the memory bank of a tenant.
+        """
+        with self._tenant_lock(tenant_id):
+            secom = self.get(tenant_id)
+            secom.update_memory_batch(new_turns)
+            self._update_usage(tenant_id, secom)
+        self.enforce_budget(keep=tenant_id)
+
+    def memory_usage(self) -> int:
+        return self.n_bytes
+
+    def over_budget(self) -> bool:
+        if self.max_tenants is not None and len(self.tenants) > self.max_tenants:
+            return True
+        if self.max_bytes is not None and self.memory_usage() > self.max_bytes:
+            return True
+        return False
+
+    def enforce_budget(
+        self,
+        keep: Optional[str] = None,
+    ):
+        """
+        Evict the least recently used tenants until the budget holds, never evicting `keep` or a busy tenant.
+        """
+        while self.over_budget():
+            with self._lock:
+                candidates = [
+                    tenant_id for tenant_id in self.tenants if tenant_id != keep
+                ]
+            for tenant_id in candidates:
+                if self.evict(tenant_id, blocking=False):
+                    break
+            else:
+                return
+
+    def evict(
+        self,
+        tenant_id: str,
+        blocking: bool = True,
+    ) -> bool:
+        """
+        Save a tenant to its snapshot and drop it from memory.
+
+        Returns:
+            bool: Whether the tenant was evicted, False if it is not in memory or busy while `blocking` is False.
+        """
+        with self._tenant_lock(tenant_id, blocking=blocking) as acquired:
+            if not acquired:
+                return False
+            with self._lock:
+                secom = self.tenants.get(tenant_id)
+            if secom is None:
+                return False
+            if len(secom.memory_bank) > 0:
+                self._save(tenant_id, secom)
+            with self._lock:
+                del self.tenants[tenant_id]
+                self.n_bytes -= self.tenant_bytes.pop(tenant_id, 0)
+            self.n_evicted += 1
+            return True
+
+    def _save(self, tenant_id, secom):
+        # write to a temporary directory first, so a failing save does not destroy the previous snapshot
+        path = self.snapshot_path(tenant_id)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        secom.save(tmp_path)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    def flush(self):
+        """
+        Save every tenant in memory to its snapshot, e.g. before the process exits.
+        """
+        with self._lock:
+            tenant_ids = list(self.tenants)
+        for tenant_id in tenant_ids:
+            with self._tenant_lock(tenant_id):
+                with self._lock:
+                    secom = self.tenants.get(tenant_id)
+                if secom is not None and len(secom.memory_bank) > 0:
+                    self._save(tenant_id, secom)
+
+    def stats(self):
+        return {
+            "n_tenants": len(self.tenants),
+            "memory_usage": self.memory_usage(),
+            "n_evicted": self.n_evicted,
+            "n_restored": self.n_restored,
+        }
@@ -0,0 +1,289 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import hashlib
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate_per_minute`, holding at most one minute worth of tokens.
+
+    Args:
+        rate_per_minute (float): The number of tokens added per minute, e.g. requests/min or tokens/min.
+    """
+
+    def __init__(
+        self,
+        rate_per_minute: float,
+    ):
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """
+        The number of seconds until `amount` tokens are available, 0 if they are available now.
+        """
+        self._refill(now)
+        # a request above the capacity waits for a full bucket rather than forever
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        # may go below zero, e.g. when the actual usage of a request exceeds its estimate
+        self.tokens -= amount
+
+
+class APIKey:
+    def __init__(
+        self,
+        key: str,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+    ):
+        self.key = key
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.cooldown_until = 0.0
+        self.disabled = False
+        # the error that disabled the key, raised again once every key is disabled
+        self.auth_error = None
+        self.n_requests = 0
+        self.n_tokens = 0
+        self.n_rate_limited = 0
+        self.n_auth_failures = 0
+        # rate limit errors since the last success
+        self.strikes = 0
+
+    def wait_time(self, n_tokens: float, now: float) -> float:
+        wait = max(0.0, self.cooldown_until - now)
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(n_tokens, now))
+        return wait
+
+    @property
+    def name(self) -> str:
+        # never expose a full key in logs or stats
+        return f"{self.key[:3]}...{self.key[-4:]}" if len(self.key) > 8 else "***"
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    The seconds to wait given by the `Retry-After` header of a failed request, None if absent.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class KeyPool:
+    """
+    Spreads requests round-robin over several API keys, each with its own requests/min and tokens/min budget.
+
+    `acquire` returns the next key whose token buckets can take the request, waiting for the earliest key
+        otherwise. A key that got a rate limit error (429) leaves the rotation for its `Retry-After` time, or else
+        for `cooldown` seconds doubled with every further rate limit error before a success (up to
+        `max_cooldown`). A key that failed authentication (401/403) rests for `auth_cooldown` seconds, and once
+        every key rests so, `acquire` raises the authentication error instead of waiting. A single key never rests
+        after an authentication error, since there is no other key to fall back on.
+
+    Args:
+        keys (List[str]): The API keys.
+        rpm (float, optional): The requests per minute allowed for each key. Default is None, unlimited.
+        tpm (float, optional): The tokens (prompt and completion) per minute allowed for each key.
+            Default is None, unlimited.
+        cooldown (float, optional): The seconds a key rests after a first rate limit error without `Retry-After`.
+            Default is 1.
+        max_cooldown (float, optional): The maximum seconds a key rests after a rate limit error. Default is 60.
+        auth_cooldown (float, optional): The seconds a key rests after an authentication error. Default is 300.
+    """
+
+    def __init__(
+        self,
+        keys: List[str],
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        cooldown: float = 1.0,
+        max_cooldown: float = 60.0,
+        auth_cooldown: float = 300.0,
+    ):
+        assert keys, "no API key configured"
+        self.keys = [APIKey(key, rpm=rpm, tpm=tpm) for key in keys]
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.auth_cooldown = auth_cooldown
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_tokens(api_kwargs: dict) -> int:
+        # about 4 characters per token, and the completion budget in full
+        n_chars = sum(len(str(m.get("content", ""))) for m in api_kwargs["messages"])
+        return n_chars // 4 + api_kwargs.get("max_tokens", 0)
+
+    def _try_acquire(self, n_tokens) -> Tuple[Optional[str], float]:
+        with self._lock:
+            now = time.monotonic()
+            if all(key.disabled and key.cooldown_until > now for key in self.keys):
+                # the original error classifies as "auth" rather than a retryable failure; its traceback is dropped
+                # so that raising it again does not chain onto the previous ones
+                raise self.keys[0].auth_error.with_traceback(None)
+            min_wait = float("inf")
+            for i in range(len(self.keys)):
+                key = self.keys[(self._next + i) % len(self.keys)]
+                wait = key.wait_time(n_tokens, now)
+                if wait == 0:
+                    key.disabled = False
+                    if key.requests is not None:
+                        key.requests.consume(1)
+                    if key.tokens is not None:
+                        key.tokens.consume(n_tokens)
+                    key.n_requests += 1
+                    self._next = (self._next + i + 1) % len(self.keys)
+                    return key.key, 0.0
+                min_wait = min(min_wait, wait)
+            return None, min_wait
+
+    def acquire(self, n_tokens: int = 0) -> str:
+        """
+        Return the key to send a request of about `n_tokens` tokens with, blocking until one is available.
+        """
+        while True:
+            key, wait = self._try_acquire(n_tokens)
+            if key is not None:
+                return key
+            time.sleep(wait)
+
+    async def aacquire(self, n_tokens: int = 0) -> str:
+        import asyncio
+
+        while True:
+            key, wait = self._try_acquire(n_tokens)
+            if key is not None:
+                return key
+            await asyncio.sleep(wait)
+
+    def _find(self, key: str) -> APIKey:
+        return next(k for k in self.keys if k.key == key)
+
+    def record_usage(
+        self,
+        key: str,
+        estimated_tokens: int,
+        used_tokens: Optional[int],
+    ):
+        """
+        Record the success of a request acquired with `estimated_tokens`, correcting the tokens/min budget of
+            `key` by its actual usage.
+        """
+        with self._lock:
+            api_key = self._find(key)
+            api_key.strikes = 0
+            if used_tokens is None:
+                return
+            api_key.n_tokens += used_tokens
+            if api_key.tokens is not None:
+                api_key.tokens.consume(used_tokens - estimated_tokens)
+
+    def report_error(
+        self,
+        key: str,
+        error: Exception,
+    ):
+        """
+        Take `key` out of the rotation after a rate limit or authentication error, other errors are ignored.
+        """
+        status = getattr(error, "status_code", None)
+        if status not in (401, 403, 429):
+            return
+        with self._lock:
+            api_key = self._find(key)
+            now = time.monotonic()
+            if status == 429:
+                api_key.n_rate_limited += 1
+                wait = retry_after(error)
+                if wait is None and api_key.cooldown_until > now:
+                    # another request of the same burst, the key is already resting
+                    return
+                api_key.strikes += 1
+                if wait is None:
+                    wait = min(
+                        self.max_cooldown, self.cooldown * 2 ** (api_key.strikes - 1)
+                    )
+                api_key.cooldown_until = now + wait
+            else:
+                api_key.n_auth_failures += 1
+                if len(self.keys) > 1:
+                    api_key.disabled = True
+                    api_key.auth_error = error
+                    api_key.cooldown_until = now + self.auth_cooldown
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                key.name: {
+                    "requests": key.n_requests,
+                    "tokens": key.n_tokens,
+                    "rate_limited": key.n_rate_limited,
+                    "auth_failures": key.n_auth_failures,
+                    "cooling_down": key.cooldown_until > now,
+                }
+                for key in self.keys
+            }
+
+
+# key pools shared by the clients of the process, apart from the model registry so that unloading models keeps the
+# token buckets and cooldowns
+_key_pools = {}
+_key_pools_lock = threading.Lock()
+
+
+def get_key_pool(
+    keys: List[str],
+    rpm: Optional[float] = None,
+    tpm: Optional[float] = None,
+    cooldown: float = 1.0,
+) -> KeyPool:
+    """
+    The `KeyPool` of a set of keys and budgets, shared by every client of the process using them.
+    """
+    # keyed by a digest, the keys themselves are not kept outside the pool
+    digest = hashlib.sha256(",".join(keys).encode("utf-8")).hexdigest()
+    with _key_pools_lock:
+        if (digest, rpm, tpm, cooldown) not in _key_pools:
+            _key_pools[digest, rpm, tpm, cooldown] = KeyPool(
+                keys, rpm=rpm, tpm=tpm, cooldown=cooldown
+            )
+        return _key_pools[digest, rpm, tpm, cooldown]
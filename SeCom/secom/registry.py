@@ -0,0 +1,163 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import gc
+import threading
+from typing import Callable, Hashable, List, Optional, Tuple
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of the models used by SeCom, so that every SeCom instance in a process shares one copy.
+
+    Models are keyed by (kind, name, device) and loaded on first request; concurrent requests for the same model
+        wait for a single load. `warmup` loads the models of a config ahead of time and `unload` releases them.
+
+    Example:
+        >>> from secom import SeCom, registry
+        >>> registry.warmup(OmegaConf.load("configs/mpnet.yaml"))
+        >>> memory_managers = [SeCom(config_path="configs/mpnet.yaml") for _ in range(100)]
+        # All instances share one mpnet embedding model, one LLMLingua-2 compressor and one tokenizer.
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        key: Tuple[Hashable, ...],
+        loader: Callable[[], object],
+    ):
+        """
+        Return the model registered under `key`, loading it with `loader` if it is not loaded yet.
+        """
+        with self._lock:
+            if key in self._models:
+                return self._models[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._models:
+                    return self._models[key]
+            model = loader()
+            with self._lock:
+                self._models[key] = model
+            return model
+
+    def get_embeddings(
+        self,
+        model_name: str,
+        device: str = "cuda",
+    ):
+        def load():
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+
+            return HuggingFaceEmbeddings(
+                model_name=model_name, model_kwargs={"device": device}
+            )
+
+        return self.get(("embeddings", model_name, device), load)
+
+    def get_embedding_cache(
+        self,
+        cache_dir: str,
+        model_name: str,
+        dtype: str = "float32",
+    ):
+        def load():
+            from .embeddings import EmbeddingCache
+
+            return EmbeddingCache(cache_dir, model_name, dtype=dtype)
+
+        return self.get(("embedding_cache", model_name, (cache_dir, dtype)), load)
+
+    def get_compressor(
+        self,
+        model_name: str,
+        device: str = "cuda",
+        batch_size: int = 50,
+    ):
+        """
+        The LLMLingua-2 `PromptCompressor`. `batch_size` only applies to the instance that loads the model.
+        """
+
+        def load():
+            from llmlingua import PromptCompressor
+
+            return PromptCompressor(
+                model_name,
+                device_map=device,
+                use_llmlingua2=True,
+                llmlingua2_config={"max_batch_size": batch_size},
+            )
+
+        return self.get(("compressor", model_name, device), load)
+
+    def get_tokenizer(
+        self,
+        model_name: str = "gpt-4",
+    ):
+        def load():
+            import tiktoken
+
+            return tiktoken.encoding_for_model(model_name)
+
+        return self.get(("tokenizer", model_name, None), load)
+
+    def warmup(
+        self,
+        config,
+    ):
+        """
+        Load the compressor, the embedding model and the tokenizer of a SeCom config ahead of the first request.
+        """
+        self.get_tokenizer("gpt-4")
+        if "compressor" in config:
+            self.get_compressor(
+                config.compressor.compress_model,
+                config.compressor.get("device_map", "cuda"),
+                config.compressor.get("batch_size", 50),
+            )
+        if config.get("retriever", {}).get("embedding_model"):
+            self.get_embeddings(
+                config.retriever.embedding_model,
+                config.retriever.get("device_map", "cuda"),
+            )
+
+    def loaded(self) -> List[Tuple[Hashable, ...]]:
+        with self._lock:
+            return list(self._models)
+
+    def unload(
+        self,
+        kind: Optional[str] = None,
+        name: Optional[str] = None,
+        device: Optional[str] = None,
+    ):
+        """
+        Drop the matching models from the registry, every model if no filter is given.
+
+        Instances still holding a model keep it alive until they are released.
+        """
+        with self._lock:
+            for key in list(self._models):
+                if (
+                    (kind is None or key[0] == kind)
+                    and (name is None or key[1] == name)
+                    and (device is None or key[2] == device)
+                ):
+                    del self._models[key]
+                    self._key_locks.pop(key, None)
+        gc.collect()
+        try:
+            import torch
+
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+
+registry = ModelRegistry()
@@ -0,0 +1,314 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import random
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, Dict, Iterable, Optional
+
+from .ratelimit import retry_after
+
+ERROR_CLASSES = (
+    "rate_limit",
+    "server",
+    "timeout",
+    "connection",
+    "auth",
+    "client",
+    "other",
+)
+
+# error classes that signal an overloaded endpoint, as opposed to a bad request
+OVERLOAD_CLASSES = ("rate_limit", "server", "timeout")
+
+
+def classify_error(error: Exception) -> str:
+    """
+    The class of a failed LLM request, one of `ERROR_CLASSES`.
+
+    Errors of the openai and httpx clients are recognized by their status code and class name, so that neither
+        package has to be imported.
+    """
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        if status == 429:
+            return "rate_limit"
+        if status in (401, 403):
+            return "auth"
+        if status == 408:
+            return "timeout"
+        if status >= 500:
+            return "server"
+        return "client"
+    names = {cls.__name__ for cls in type(error).__mro__}
+    if names & {"APITimeoutError", "TimeoutException", "TimeoutError"}:
+        return "timeout"
+    if names & {"APIConnectionError", "TransportError", "ConnectionError"}:
+        return "connection"
+    return "other"
+
+
+class RetryPolicy:
+    """
+    When and how long to wait before retrying a failed LLM request.
+
+    The delay grows exponentially from `base_delay` up to `max_delay`, with full jitter (a uniform draw below the
+        exponential bound) so that concurrent clients do not retry in lockstep. A `Retry-After` header of the
+        endpoint takes precedence. Only the error classes in `retry_on` are retried: a malformed request ("client")
+        fails the same way again, and an authentication error only succeeds with another key.
+
+    Args:
+        max_attempts (int, optional): The maximum number of attempts of a request, the first included. Default is 4.
+        base_delay (float, optional): The bound of the first delay in seconds. Default is 1.
+        max_delay (float, optional): The maximum delay in seconds, also capping `Retry-After`. Default is 60.
+        retry_on (Iterable[str], optional): The retried error classes, see `classify_error`.
+            Default is all but "auth" and "client".
+        respect_retry_after (bool, optional): Wait for the `Retry-After` of the endpoint if given. Default is True.
+        on_retry (Callable[[Exception], None], optional): Called with the error of every retried attempt, e.g. to
+            record it in `llm_metrics`. Default is None.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        retry_on: Optional[Iterable[str]] = None,
+        respect_retry_after: bool = True,
+        on_retry: Optional[Callable[[Exception], None]] = None,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = set(
+            retry_on
+            if retry_on is not None
+            else ("rate_limit", "server", "timeout", "connection", "other")
+        )
+        unknown = self.retry_on - set(ERROR_CLASSES)
+        assert not unknown, f"unknown error classes {unknown}"
+        self.respect_retry_after = respect_retry_after
+        self.on_retry = on_retry
+        self.retries = Counter()
+        self._lock = threading.Lock()
+
+    def should_retry(
+        self,
+        error: Exception,
+        attempt: int,
+        max_attempts: Optional[int] = None,
+    ) -> bool:
+        """
+        Whether to retry after `error` failed the `attempt`-th attempt, counted from 0.
+        """
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        return attempt + 1 < max_attempts and classify_error(error) in self.retry_on
+
+    def delay(
+        self,
+        attempt: int,
+        error: Optional[Exception] = None,
+    ) -> float:
+        if error is not None and self.respect_retry_after:
+            wait = retry_after(error)
+            if wait is not None:
+                return min(wait, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def record(self, error: Exception):
+        with self._lock:
+            self.retries[classify_error(error)] += 1
+        if self.on_retry is not None:
+            self.on_retry(error)
+
+    def call(
+        self,
+        fn: Callable,
+        *args,
+        **kwargs,
+    ):
+        """
+        Call `fn(*args, **kwargs)`, retrying it according to the policy.
+        """
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not self.should_retry(e, attempt):
+                    raise
+                self.record(e)
+                delay = self.delay(attempt, e)
+                print(
+                    f"Retry {attempt + 1}/{self.max_attempts - 1} in {delay:.1f}s after "
+                    f"{classify_error(e)} error: {e}",
+                    flush=True,
+                )
+                time.sleep(delay)
+                attempt += 1
+
+    async def acall(
+        self,
+        fn: Callable,
+        *args,
+        **kwargs,
+    ):
+        """
+        Await `fn(*args, **kwargs)`, retrying it according to the policy.
+        """
+        import asyncio
+
+        attempt = 0
+        while True:
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                if not self.should_retry(e, attempt):
+                    raise
+                self.record(e)
+                delay = self.delay(attempt, e)
+                print(
+                    f"Retry {attempt + 1}/{self.max_attempts - 1} in {delay:.1f}s after "
+                    f"{classify_error(e)} error: {e}",
+                    flush=True,
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.retries)
+
+
+class AIMDLimiter:
+    """
+    Limits the requests in flight to an endpoint, adapting the limit by additive increase, multiplicative decrease.
+
+    Every successful request raises the limit by `increase / limit`, i.e. by `increase` per window of `limit`
+        requests, until `max_limit`. A request failing with an overload error (429, 5xx or a timeout) multiplies it
+        by `decrease`, at most once per `decrease_interval` seconds, since the requests in flight at that time
+        report the same overload. Sync callers wait in `acquire`, async callers in `aacquire`; both share the limit.
+
+    Args:
+        initial (int, optional): The initial limit. Default is 8.
+        min_limit (int, optional): The minimum limit. Default is 1.
+        max_limit (int, optional): The maximum limit. Default is 256.
+        increase (float, optional): The additive increase per window. Default is 1.
+        decrease (float, optional): The multiplicative decrease. Default is 0.5.
+        decrease_interval (float, optional): The minimum seconds between two decreases. Default is 1.
+    """
+
+    def __init__(
+        self,
+        initial: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 256,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        decrease_interval: float = 1.0,
+    ):
+        assert 1 <= min_limit <= initial <= max_limit, "limits out of order"
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.decrease_interval = decrease_interval
+        self.in_flight = 0
+        self.n_decreases = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._waiters = deque()
+
+    def _has_capacity(self):
+        return self.in_flight < int(self.limit)
+
+    def acquire(self):
+        with self._cond:
+            while not self._has_capacity():
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def aacquire(self):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._has_capacity():
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            await waiter
+
+    def release(
+        self,
+        error: Optional[Exception] = None,
+        adapt: bool = True,
+    ):
+        """
+        Release a slot, adapting the limit to the outcome of its request, `error` None on success.
+
+        A request abandoned without an outcome, e.g. cancelled, is released with `adapt=False`.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if not adapt:
+                pass
+            elif error is None:
+                self.limit = min(
+                    self.max_limit, self.limit + self.increase / self.limit
+                )
+            elif classify_error(error) in OVERLOAD_CLASSES:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.decrease_interval:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self._last_decrease = now
+                    self.n_decreases += 1
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, deque()
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def has_capacity(self) -> bool:
+        """
+        Whether a request can start without waiting, e.g. to decide on an optional duplicate request.
+        """
+        with self._cond:
+            return self._has_capacity()
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "decreases": self.n_decreases,
+            }
+
+
+# limiters shared by the clients of an endpoint, apart from the model registry so that unloading models keeps the
+# adapted limits
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(
+    endpoint: str,
+    **kwargs,
+) -> AIMDLimiter:
+    """
+    The `AIMDLimiter` of an endpoint (its base URL) and settings, shared by every client of the process.
+    """
+    key = (endpoint, tuple(sorted(kwargs.items())))
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = AIMDLimiter(**kwargs)
+        return _limiters[key]
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
@@ -3,16 +3,22 @@
 
 import json
 import os
+import pickle
+import sys
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
-import tiktoken
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_core.documents import Document
-from llmlingua import PromptCompressor
-from omegaconf import OmegaConf
-
+from .backends import get_storage_class
+from .cache import CompressionCache, LLMResponseCache
+from .registry import ModelRegistry
+from .registry import registry as default_registry
+from .telemetry import llm_metrics
 from .utils import OpenAILLM, extract_result, extract_yes_no
+from .version import VERSION
+
+# Heavy dependencies (langchain, llmlingua, tiktoken, openai, omegaconf) are imported where they are first used,
+# and models are loaded on first use, so that importing secom and restoring a saved memory bank stay cheap.
 
 
 class SeCom:
@@ -29,6 +35,8 @@ class SeCom:
     Args:
         granularity (str, optional): The granularity to construct memory bank and perform retrieval. Default is "segment".
         config_path (str, optional): The path to load config. Default config is "configs/mpnet.yaml"
+        registry (ModelRegistry, optional): The registry to load the compressor, embedding model and tokenizer from.
+            Default is the process-wide registry, so that all instances share one copy of each model.
     Example:
         >>> memory_manager = SeCom(granularity="segment", config_path="configs/mpnet.yaml")
         >>> conversation_history = [["First session of a very looooooong conversation history", "The second user-bot turn of the first session"], ["Second Session ..."]]
@@ -45,23 +53,91 @@ class SeCom:
         config_path: str = os.path.join(
             os.path.dirname(os.path.abspath(__file__)), "configs/mpnet.yaml"
         ),
+        registry: ModelRegistry = None,
     ):
+        from omegaconf import OmegaConf
+
         self.root_dir = os.path.dirname(os.path.abspath(__file__))
         self.granularity = granularity
         self.config_path = config_path
         self.config = OmegaConf.load(self.config_path)
-        self.tokenizer = tiktoken.encoding_for_model("gpt-4")
+        self.registry = registry if registry is not None else default_registry
+        self._tokenizer = None
 
         self.segments = []
         self.memory_bank = []
+        self.retriever = None
+        self.storage = None
+        self.retrieve_topk = None
+        self.embedding_model = ""
 
-        self.segmentor = None
+        self._segmentor = None
+        self.segmentor_kwargs = None
+        self.segment_workers = 1
+        self.segment_concurrency = 64
+        self.segment_method = "llm"
+        self._tiling_segmentor = None
+        self.tiling_segmentor_kwargs = None
+        self._segment_gate = None
+        self.segment_gate_kwargs = None
         if "segmentor" in self.config:
             self.init_segmentor(**self.config.segmentor)
-        self.compressor = None
+        self._compressor = None
+        self.compressor_kwargs = None
+        self.compress_cache = None
         if "compressor" in self.config:
             self.init_compressor(**self.config.compressor)
 
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = self.registry.get_tokenizer("gpt-4")
+        return self._tokenizer
+
+    @property
+    def segmentor(self):
+        if self._segmentor is None and self.segmentor_kwargs is not None:
+            self._segmentor = OpenAILLM(**self.segmentor_kwargs)
+        return self._segmentor
+
+    @segmentor.setter
+    def segmentor(self, segmentor):
+        self._segmentor = segmentor
+
+    @property
+    def tiling_segmentor(self):
+        if self._tiling_segmentor is None and self.tiling_segmentor_kwargs is not None:
+            from .segmentation import TextTilingSegmentor
+
+            kwargs = dict(self.tiling_segmentor_kwargs)
+            embeddings = self.registry.get_embeddings(
+                kwargs.pop("embedding_model"), kwargs.pop("device")
+            )
+            self._tiling_segmentor = TextTilingSegmentor(embeddings, **kwargs)
+        return self._tiling_segmentor
+
+    @property
+    def segment_gate(self):
+        if self._segment_gate is None and self.segment_gate_kwargs is not None:
+            from .segmentation import SimilarityGate
+
+            kwargs = dict(self.segment_gate_kwargs)
+            embeddings = self.registry.get_embeddings(
+                kwargs.pop("embedding_model"), kwargs.pop("device")
+            )
+            self._segment_gate = SimilarityGate(embeddings, **kwargs)
+        return self._segment_gate
+
+    @property
+    def compressor(self):
+        if self._compressor is None and self.compressor_kwargs is not None:
+            self._compressor = self.registry.get_compressor(**self.compressor_kwargs)
+        return self._compressor
+
+    @compressor.setter
+    def compressor(self, compressor):
+        self._compressor = compressor
+
     def clear(
         self,
     ):
@@ -128,16 +204,122 @@ class SeCom:
             replace_last = self.update_segment(new_turn)
         elif self.granularity == "session":
             assert len(self.memory_bank) > 0
-            self.memory_bank[-1].page_content += f"\n{new_turn}"
-            self.memory_bank[-1].metadata["content"].append(new_turn)
+            # assigned back, a memory bank restored by `SeCom.load` decodes a new Document on every access
+            self.memory_bank[-1] = self.extend_memory_unit(
+                self.memory_bank[-1], new_turn
+            )
             replace_last = True
         elif self.granularity == "turn":
             self.memory_bank.append(
-                Document(page_content=new_turn, metadata={"content": new_turn}),
-                ids=[len(self.memory_bank) - 1],
+                self.make_memory_unit([new_turn], len(self.memory_bank))
             )
         self.update_database(replace_last)
 
+    async def aupdate_memory(
+        self,
+        new_turn: str,
+    ):
+        """
+        The async counterpart of `update_memory`, which awaits the LLM decision of the segment granularity.
+
+        Updates of one memory bank must not overlap, await each call before the next one; updates of different
+            memory banks can run concurrently.
+
+        Args:
+            new_turn（str): New user-bot interaction turn to be added to the memroy bank.
+
+        Returns:
+            update the built-in memory bank, return nothing.
+        """
+        if self.granularity != "segment":
+            return self.update_memory(new_turn)
+        assert len(self.memory_bank) > 0, "pass in conversation_history first"
+        self.update_database(await self.aupdate_segment(new_turn))
+
+    def update_memory_batch(
+        self,
+        new_turns: List[str],
+    ):
+        """
+        Add a burst of newly evolved user-bot interaction turns to the memory bank at once.
+
+        With the segment granularity, the last memory unit and the new turns are segmented together by one LLM call
+            (one embedding batch for the embedding segmentor) rather than one call per turn. The new turns are
+            segmented before anything is changed, then the retriever index is updated once: the extended last
+            memory unit is replaced and the new memory units are added in one batch, so every touched memory unit is
+            embedded once. The memory bank is changed only after the index, so a failed embedding call leaves both
+            as they were.
+
+        Args:
+            new_turns (List[str]): New user-bot interaction turns to be added to the memory bank, in order.
+
+        Returns:
+            update the built-in memory bank, return nothing.
+        """
+        assert len(self.memory_bank) > 0, "pass in conversation_history first"
+        if not new_turns:
+            return
+        extension, units = self.split_new_turns(list(new_turns))
+        n = len(self.memory_bank)
+        docs = []
+        if extension:
+            last = self.memory_bank[-1]
+            doc = type(last)(
+                page_content="\n".join([last.page_content] + extension),
+                metadata={
+                    **last.metadata,
+                    "content": last.metadata["content"] + extension,
+                },
+            )
+            self.count_memory_unit(doc)
+            docs.append(doc)
+        for i, unit in enumerate(units):
+            docs.append(self.make_memory_unit(unit, n + i))
+        self.index_documents(
+            n - 1 if extension else n, docs, replace_first=bool(extension)
+        )
+        if extension:
+            self.memory_bank[-1] = docs[0]
+        for doc in docs[1 if extension else 0 :]:
+            self.memory_bank.append(doc)
+
+    def split_new_turns(
+        self,
+        new_turns: List[str],
+    ):
+        """
+        Split new turns into the turns extending the last memory unit and the turns of each new memory unit.
+        """
+        if self.granularity == "session":
+            return new_turns, []
+        if self.granularity == "turn":
+            return [], [[turn] for turn in new_turns]
+
+        last = list(self.memory_bank[-1].metadata["content"])
+        exchanges = last + new_turns
+        if self.segment_method == "embedding":
+            segments = self.tiling_segmentor.segment(exchanges)
+        else:
+            segments = self.segment_session(
+                len(self.memory_bank) - 1, exchanges, site="incremental"
+            )
+        # the last memory unit is never split, only the boundaries between new turns are kept
+        starts = [0]
+        for segment in segments[:-1]:
+            starts.append(starts[-1] + len(segment))
+        edges = sorted(
+            {start for start in starts if len(last) < start < len(exchanges)}
+        )
+        edges = [len(last)] + edges + [len(exchanges)]
+        if len(last) in starts:
+            # the first new turn opens a new memory unit
+            extension = []
+        else:
+            extension = exchanges[edges[0] : edges[1]]
+            edges = edges[1:]
+        units = [exchanges[a:b] for a, b in zip(edges, edges[1:])]
+        return extension, units
+
     def build_memory(
         self,
         conversation_history: List[List[str]],
@@ -166,27 +348,110 @@ class SeCom:
                     units.append([turn])
         if compress_rate < 1:
             comp_units = self.compress(units, compress_rate)
-            self.memory_bank = [
-                Document(
-                    page_content="\n".join(comp_unit)
-                    if isinstance(comp_unit, list)
-                    else comp_unit,
-                    metadata={"content": unit, "idx": idx},
-                )
-                for idx, (unit, comp_unit) in enumerate(zip(units, comp_units))
-            ]
         else:
-            self.memory_bank = [
-                Document(
-                    page_content="\n".join(unit) if isinstance(unit, list) else unit,
-                    metadata={"content": unit, "idx": idx},
-                )
-                for idx, unit in enumerate(units)
-            ]
+            comp_units = units
+        self.memory_bank = [
+            self.make_memory_unit(unit, idx, comp_unit)
+            for idx, (unit, comp_unit) in enumerate(zip(units, comp_units))
+        ]
+
+    def make_memory_unit(self, unit, idx, comp_unit=None):
+        """
+        Build the `Document` of a memory unit, keyed by its (compressed) text.
+
+        The gpt-4 token count and the exchange count of the original unit are computed once here and kept in the
+            metadata, so that retrieval accounting does not re-tokenize the unit on every hit.
+        """
+        if comp_unit is None:
+            comp_unit = unit
+        from langchain_core.documents import Document
+
+        doc = Document(
+            page_content="\n".join(comp_unit)
+            if isinstance(comp_unit, list)
+            else comp_unit,
+            metadata={"content": unit, "idx": idx},
+        )
+        self.count_memory_unit(doc)
+        return doc
+
+    def extend_memory_unit(self, doc, new_turn):
+        doc.page_content += f"\n{new_turn}"
+        doc.metadata["content"].append(new_turn)
+        self.count_memory_unit(doc)
+        return doc
+
+    def count_memory_unit(self, doc):
+        content = doc.metadata["content"]
+        doc.metadata["n_exchange"] = len(content) if isinstance(content, list) else 0
+        doc.metadata["n_token"] = len(self.tokenizer.encode(self.unit_text(content)))
+
+    @staticmethod
+    def unit_text(content):
+        return "\n".join(content) if isinstance(content, list) else content
 
-    def init_segmentor(self, segment_model, prompt_path, incremental_prompt_path, disable_reasoning=False):
+    def init_segmentor(
+        self,
+        segment_model="",
+        prompt_path="",
+        incremental_prompt_path="",
+        disable_reasoning=False,
+        max_workers=1,
+        max_concurrency=64,
+        client_kwargs=None,
+        cache_path="",
+        cache_ttl=None,
+        cache_max_entries=None,
+        method="llm",
+        embedding_model="",
+        device_map="cuda",
+        tiling_kwargs=None,
+        gate_kwargs=None,
+    ):
         self.segment_model = segment_model
-        self.segmentor = OpenAILLM(segment_model, disable_reasoning=disable_reasoning)
+        self.segment_workers = max_workers
+        self.segment_concurrency = max_concurrency
+        self.segment_method = method
+        self._segment_gate = None
+        self.segment_gate_kwargs = None
+        if method == "embedding" or gate_kwargs:
+            # by default with the (shared) embedding model of the retriever
+            retriever_config = self.config.get("retriever", {})
+            if not embedding_model:
+                embedding_model = retriever_config.get("embedding_model", "")
+                device_map = retriever_config.get("device_map", device_map)
+            assert embedding_model, "the segmentor config needs an embedding_model"
+        if method == "embedding":
+            # offline TextTiling
+            self._tiling_segmentor = None
+            self.tiling_segmentor_kwargs = {
+                "embedding_model": embedding_model,
+                "device": device_map,
+                **(tiling_kwargs or {}),
+            }
+            return
+        assert method == "llm", f"unknown segmentation method {method}"
+        if gate_kwargs:
+            # clear cases of `update_segment` are decided locally, the others by the LLM
+            self.segment_gate_kwargs = {
+                "embedding_model": embedding_model,
+                "device": device_map,
+                **gate_kwargs,
+            }
+        cache = None
+        if cache_path:
+            cache = LLMResponseCache(
+                cache_path, max_entries=cache_max_entries, ttl=cache_ttl
+            )
+        # the client is created on the first LLM call
+        self._segmentor = None
+        self.segmentor_kwargs = {
+            "model_name": segment_model,
+            "disable_reasoning": disable_reasoning,
+            "cache": cache,
+            # e.g. max_connections of the pooled HTTP clients
+            **(client_kwargs or {}),
+        }
         with open(os.path.join(self.root_dir, prompt_path), "r", encoding="utf-8") as f:
             self.segment_prompt = f.read()
         with open(
@@ -194,42 +459,290 @@ class SeCom:
         ) as f:
             self.incremental_segment_prompt = f.read()
 
-    def init_compressor(self, compress_model):
-        self.compressor = PromptCompressor(compress_model, use_llmlingua2=True)
+    def init_compressor(
+        self,
+        compress_model,
+        batch_size=50,
+        cache_path="",
+        cache_max_entries=None,
+        device_map="cuda",
+    ):
+        self.compress_model = compress_model
+        self.compress_batch_size = batch_size
+        # the model is loaded on the first compression
+        self._compressor = None
+        self.compressor_kwargs = {
+            "model_name": compress_model,
+            "device": device_map,
+            "batch_size": batch_size,
+        }
+        if cache_path:
+            self.init_compress_cache(cache_path, cache_max_entries)
 
-    def init_retriever(self, topk, storage, embedding_model="", device_map="cuda"):
-        from langchain_community.retrievers import BM25Retriever
-        from langchain_community.vectorstores import FAISS, Chroma
+    def init_compress_cache(self, cache_path, max_entries=None):
+        self.compress_cache = CompressionCache(cache_path, max_entries=max_entries)
 
+    def init_retriever(
+        self,
+        topk,
+        storage,
+        embedding_model="",
+        device_map="cuda",
+        embedding_cache_dir="",
+        embedding_cache_dtype="float32",
+        storage_kwargs=None,
+    ):
+        self.retrieve_topk = topk
+        self.storage = storage
         self.embedding_model = embedding_model
+        storage_kwargs = dict(storage_kwargs or {})
         if embedding_model:
-            self.embeddings = HuggingFaceEmbeddings(
-                model_name=embedding_model, model_kwargs={"device": device_map}
+            self.init_embeddings(
+                embedding_model, device_map, embedding_cache_dir, embedding_cache_dtype
             )
-            self.vector_store = (locals()[storage]).from_documents(
+            self.vector_store = get_storage_class(storage).from_documents(
                 self.memory_bank,
                 self.embeddings,
                 ids=[i for i in range(len(self.memory_bank))],
+                **storage_kwargs,
             )
             self.retriever = self.vector_store.as_retriever(search_kwargs={"k": topk})
         else:
-            self.retriever = (locals()[storage]).from_documents(
-                self.memory_bank, k=topk
+            self.retriever = get_storage_class(storage).from_documents(
+                self.memory_bank, k=topk, **storage_kwargs
             )
 
-    def update_database(self, replace_last=False):
+    def init_embeddings(
+        self,
+        embedding_model,
+        device_map="cuda",
+        embedding_cache_dir="",
+        embedding_cache_dtype="float32",
+    ):
+        self.embeddings = self.registry.get_embeddings(embedding_model, device_map)
+        if embedding_cache_dir:
+            from .embeddings import CachedEmbeddings
+
+            # unchanged memory units are served from the on-disk cache instead of being embedded again
+            self.embeddings = CachedEmbeddings(
+                self.embeddings,
+                self.registry.get_embedding_cache(
+                    embedding_cache_dir, embedding_model, embedding_cache_dtype
+                ),
+            )
+
+    def update_database(self, replace_last=False, n_added=None):
+        """
+        Apply the latest memory bank changes to the retriever index.
+
+        Args:
+            replace_last (bool, optional): Whether the memory unit before the added ones was changed. Default is False.
+            n_added (int, optional): The number of memory units appended at the end of the memory bank.
+                Default is None, 0 if `replace_last` else 1.
+        """
+        if n_added is None:
+            n_added = 0 if replace_last else 1
+        n = len(self.memory_bank)
+        start = n - n_added - 1 if replace_last else n - n_added
+        if start == n:
+            return
+        self.index_documents(
+            start, list(self.memory_bank[start:]), replace_first=replace_last
+        )
+
+    def index_documents(self, start, documents, replace_first=False):
+        """
+        Write memory units to the retriever index from position `start` on, the first one replacing the memory unit
+            at `start` if `replace_first`, the others appended.
+
+        Backends with `update_documents` embed all of them before changing anything, so a failed embedding call
+            leaves the index untouched.
+        """
+        if not documents:
+            return
+        index = self.vector_store if self.embedding_model else self.retriever
+        if hasattr(index, "update_documents"):
+            index.update_documents(start, documents)
+        elif hasattr(index, "replace_document"):
+            # incremental backends, the changed memory unit is updated in place
+            if replace_first:
+                index.replace_document(start, documents[0])
+            if len(documents) > int(replace_first):
+                index.add_documents(documents[int(replace_first) :])
+        elif self.embedding_model:
+            ids = list(range(start, start + len(documents)))
+            if hasattr(self.vector_store, "add_embeddings"):
+                # e.g. FAISS, embedded before the replaced memory unit is deleted
+                texts = [doc.page_content for doc in documents]
+                embeddings = self.embeddings.embed_documents(texts)
+                if replace_first:
+                    self.vector_store.delete(ids=[start])
+                self.vector_store.add_embeddings(
+                    list(zip(texts, embeddings)),
+                    metadatas=[doc.metadata for doc in documents],
+                    ids=ids,
+                )
+                return
+            if replace_first:
+                self.vector_store.delete(ids=[start])
+            self.vector_store.add_documents(documents, ids=ids)
+
+    def save(
+        self,
+        path: str,
+    ):
+        """
+        Save the memory bank and the retriever index to a directory, so that it can be restored by `SeCom.load`
+            without segmenting, compressing and embedding the conversation history again.
+
+        Args:
+            path (str): The directory to save to. It is created if it does not exist.
+
+        Returns:
+            write the snapshot to `path`, return nothing.
+        """
+        from omegaconf import OmegaConf
+
+        from .docstore import MappedDocumentStore
+
+        assert len(self.memory_bank) > 0, "pass in conversation_history first"
+        os.makedirs(path, exist_ok=True)
+        OmegaConf.save(self.config, os.path.join(path, "config.yaml"))
+        MappedDocumentStore.write(os.path.join(path, "memory_bank"), self.memory_bank)
+
+        state = {
+            "version": VERSION,
+            "granularity": self.granularity,
+            "storage": None,
+            "embedding_model": self.embedding_model,
+            "retrieve_topk": None,
+        }
+        if self.retriever is not None:
+            state["storage"] = self.storage
+            state["retrieve_topk"] = self.retrieve_topk
+            if self.embedding_model:
+                if not hasattr(self.vector_store, "save_local"):
+                    raise NotImplementedError(
+                        f"saving {self.storage} vector store is not supported"
+                    )
+                self.vector_store.save_local(os.path.join(path, "index"))
+            else:
+                with open(os.path.join(path, "index.pkl"), "wb") as f:
+                    pickle.dump(self.retriever, f)
+        with open(os.path.join(path, "state.json"), "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        config_path: str = "",
+        registry: ModelRegistry = None,
+    ):
+        """
+        Restore a SeCom instance saved by `SeCom.save`.
+
+        Args:
+            path (str): The directory of the snapshot.
+            config_path (str, optional): The path to load config. Default is the config saved with the snapshot.
+            registry (ModelRegistry, optional): The registry to load models from. Default is the process-wide registry.
+
+        Returns:
+            SeCom: The restored instance, ready for `get_memory` and `update_memory` without conversation_history.
+        """
+        from .docstore import MappedDocumentStore
+
+        with open(os.path.join(path, "state.json"), "r", encoding="utf-8") as f:
+            state = json.load(f)
+        secom = cls(
+            granularity=state["granularity"],
+            config_path=config_path or os.path.join(path, "config.yaml"),
+            registry=registry,
+        )
+        if MappedDocumentStore.exists(os.path.join(path, "memory_bank")):
+            secom.memory_bank = MappedDocumentStore(os.path.join(path, "memory_bank"))
+        else:
+            # snapshots written before the memory-mapped format
+            from langchain_core.documents import Document
+
+            with open(
+                os.path.join(path, "memory_bank.jsonl"), "r", encoding="utf-8"
+            ) as f:
+                secom.memory_bank = [
+                    Document(**json.loads(line)) for line in f if line.strip()
+                ]
+        if state["storage"] is not None:
+            secom.load_retriever(path, state)
+        return secom
+
+    def load_retriever(self, path, state):
+        retriever_config = self.config.retriever
+        assert (
+            retriever_config.storage == state["storage"]
+            and retriever_config.get("embedding_model", "") == state["embedding_model"]
+        ), "retriever config does not match the snapshot"
+
+        self.retrieve_topk = state["retrieve_topk"]
+        self.storage = state["storage"]
+        self.embedding_model = state["embedding_model"]
         if self.embedding_model:
-            if replace_last:
-                self.vector_store.delete(ids=[len(self.memory_bank) - 1])
-            self.vector_store.add_documents(
-                [self.memory_bank[-1]], ids=[len(self.memory_bank) - 1]
+            self.init_embeddings(
+                self.embedding_model,
+                retriever_config.get("device_map", "cuda"),
+                retriever_config.get("embedding_cache_dir", ""),
+                retriever_config.get("embedding_cache_dtype", "float32"),
             )
+            self.vector_store = get_storage_class(self.storage).load_local(
+                os.path.join(path, "index"),
+                self.embeddings,
+                allow_dangerous_deserialization=True,
+                **retriever_config.get("storage_kwargs", {}),
+            )
+            self.retriever = self.vector_store.as_retriever(
+                search_kwargs={"k": self.retrieve_topk}
+            )
+        else:
+            with open(os.path.join(path, "index.pkl"), "rb") as f:
+                self.retriever = pickle.load(f)
+
+    def memory_usage(self):
+        """
+        Estimate the bytes held by the memory bank and the retriever index, e.g. to budget many instances in one process.
+
+        Models are shared through the registry and are not counted.
+        """
+        n_bytes = 0
+        if hasattr(self.memory_bank, "memory_usage"):
+            # memory-mapped memory bank restored by `SeCom.load`
+            n_bytes += self.memory_bank.memory_usage()
+        else:
+            for doc in self.memory_bank:
+                n_bytes += sys.getsizeof(doc.page_content)
+                content = doc.metadata["content"]
+                for text in content if isinstance(content, list) else [content]:
+                    n_bytes += sys.getsizeof(text)
+        if self.retriever is None:
+            return n_bytes
+        index = self.vector_store if self.embedding_model else self.retriever
+        if hasattr(index, "memory_usage"):
+            n_bytes += index.memory_usage()
+        elif self.embedding_model:
+            index = getattr(self.vector_store, "index", None)
+            if index is not None and hasattr(index, "ntotal"):
+                # FAISS keeps float32 vectors next to a copy of every document in its docstore
+                n_bytes = 2 * n_bytes + index.ntotal * index.d * 4
+        else:
+            n_bytes *= 2
+        return n_bytes
 
     def update_retriever(self, topk):
         if self.embedding_model:
             self.retriever = self.vector_store.as_retriever(search_kwargs={"k": topk})
+        elif hasattr(self.retriever, "replace_document"):
+            self.retriever.k = topk
         else:
             self.retriever = self.retriever.from_documents(self.memory_bank, k=topk)
+        self.retrieve_topk = topk
 
     def prefix_exchanges_with_idx(self, exchanges):
         exchanges_str_with_idx = ""
@@ -240,70 +753,219 @@ class SeCom:
     def segment(
         self,
         sessions,
+        max_workers=None,
     ):
-        segments = []
-        for session_idx, exchanges in enumerate(sessions):
-            exchanges_str_with_idx = self.prefix_exchanges_with_idx(exchanges)
+        """
+        Segment each session into topically coherent segments.
 
-            prompt = self.segment_prompt.format(
-                text_to_be_segmented=exchanges_str_with_idx
-            )
-            response = self.segmentor(prompt, max_tokens=4096)
+        Args:
+            sessions (List[List[str]]): List of sessions that consists of multiple user-bot interaction turns.
+            max_workers (int, optional): The maximum number of sessions segmented concurrently.
+                Default is None, using the `max_workers` of the segmentor config (1, i.e. sequential, if not set).
+                Not used by the embedding segmentor, which embeds all sessions in one batch.
 
-            seg_jsonl, extract_success = extract_result(response, "segmentation")
-            if not extract_success:
-                success = False
-                print(f"bad response: {response}")
-            else:
-                success = True
-                lines = seg_jsonl.strip().split("\n")
-                num_exchanges = []
-                segmentations = []
-                prev_idx = 0
-                for line in lines:
-                    try:
-                        line_dict = json.loads(line.strip().strip(","))
-                        n_ex = int(line_dict["num_exchanges"])
-                        num_exchanges.append(n_ex)
-                        segmentations.append(exchanges[prev_idx : prev_idx + n_ex])
-                        prev_idx = prev_idx + n_ex
-                    except Exception:
-                        print(traceback.format_exc())
-                        success = False
-                        break
-            if success:
-                print(
-                    f"{session_idx}-th session is segmented to {len(segmentations)} segments"
+        Returns:
+            List[List[str]]: The segments of all sessions, in session order.
+        """
+        if self.segment_method == "embedding":
+            return self.tiling_segmentor.segment_sessions(sessions)
+        if max_workers is None:
+            max_workers = self.segment_workers
+        if max_workers > 1 and len(sessions) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(max_workers, len(sessions))
+            ) as executor:
+                session_segments = list(
+                    executor.map(self.segment_session, range(len(sessions)), sessions)
                 )
-                segments.extend(segmentations)
-            else:
-                print(f"{session_idx}-th session not segmented")
-                for i in range(0, len(exchanges), 3):
-                    segments.append(exchanges[i : i + 3])
+        else:
+            session_segments = [
+                self.segment_session(session_idx, exchanges)
+                for session_idx, exchanges in enumerate(sessions)
+            ]
+
+        segments = []
+        for segmentations in session_segments:
+            segments.extend(segmentations)
+        return segments
+
+    async def asegment(
+        self,
+        sessions,
+        max_concurrency=None,
+    ):
+        """
+        Segment each session like `segment`, with the sessions segmented concurrently by async LLM calls.
+
+        Args:
+            sessions (List[List[str]]): List of sessions that consists of multiple user-bot interaction turns.
+            max_concurrency (int, optional): The maximum number of sessions segmented at the same time.
+                Default is None, using the `max_concurrency` of the segmentor config (64 if not set).
+
+        Returns:
+            List[List[str]]: The segments of all sessions, in session order.
+        """
+        import asyncio
+
+        if self.segment_method == "embedding":
+            return self.tiling_segmentor.segment_sessions(sessions)
+        semaphore = asyncio.Semaphore(max_concurrency or self.segment_concurrency)
 
+        async def segment_session(session_idx, exchanges):
+            async with semaphore:
+                return await self.asegment_session(session_idx, exchanges)
+
+        session_segments = await asyncio.gather(
+            *[
+                segment_session(session_idx, exchanges)
+                for session_idx, exchanges in enumerate(sessions)
+            ]
+        )
+        segments = []
+        for segmentations in session_segments:
+            segments.extend(segmentations)
         return segments
 
+    def segment_session(
+        self,
+        session_idx,
+        exchanges,
+        site="segment",
+    ):
+        prompt = self.segment_prompt.format(
+            text_to_be_segmented=self.prefix_exchanges_with_idx(exchanges)
+        )
+        with llm_metrics.site(site):
+            response = self.segmentor(prompt, max_tokens=4096)
+        return self.parse_segmentation(session_idx, exchanges, response)
+
+    async def asegment_session(
+        self,
+        session_idx,
+        exchanges,
+        site="segment",
+    ):
+        prompt = self.segment_prompt.format(
+            text_to_be_segmented=self.prefix_exchanges_with_idx(exchanges)
+        )
+        with llm_metrics.site(site):
+            response = await self.acall_segmentor(prompt, max_tokens=4096)
+        return self.parse_segmentation(session_idx, exchanges, response)
+
+    def parse_segmentation(
+        self,
+        session_idx,
+        exchanges,
+        response,
+    ):
+        seg_jsonl, extract_success = extract_result(response, "segmentation")
+        if not extract_success:
+            success = False
+            print(f"bad response: {response}")
+        else:
+            success = True
+            lines = seg_jsonl.strip().split("\n")
+            num_exchanges = []
+            segmentations = []
+            prev_idx = 0
+            for line in lines:
+                try:
+                    line_dict = json.loads(line.strip().strip(","))
+                    n_ex = int(line_dict["num_exchanges"])
+                    num_exchanges.append(n_ex)
+                    segmentations.append(exchanges[prev_idx : prev_idx + n_ex])
+                    prev_idx = prev_idx + n_ex
+                except Exception:
+                    print(traceback.format_exc())
+                    success = False
+                    break
+        if success:
+            print(
+                f"{session_idx}-th session is segmented to {len(segmentations)} segments"
+            )
+            return segmentations
+
+        print(f"{session_idx}-th session not segmented")
+        return [exchanges[i : i + 3] for i in range(0, len(exchanges), 3)]
+
+    async def acall_segmentor(self, prompt, **kwargs):
+        if hasattr(self.segmentor, "acall"):
+            return await self.segmentor.acall(prompt, **kwargs)
+        # a plain callable segmentor runs in the default thread pool, under the call site of the caller
+        import asyncio
+        import contextvars
+        import functools
+
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            contextvars.copy_context().run,
+            functools.partial(self.segmentor, prompt, **kwargs),
+        )
+
     def update_segment(
         self,
         new_turn: str,
     ):
+        include = self.decide_segment_locally(new_turn)
+        if include is None:
+            with llm_metrics.site("incremental"):
+                response = self.segmentor(
+                    self.incremental_segment_prompt_for(new_turn), max_tokens=4096
+                )
+            include = extract_yes_no(response)
+        return self.apply_segment_decision(new_turn, include)
+
+    async def aupdate_segment(
+        self,
+        new_turn: str,
+    ):
+        include = self.decide_segment_locally(new_turn)
+        if include is None:
+            with llm_metrics.site("incremental"):
+                response = await self.acall_segmentor(
+                    self.incremental_segment_prompt_for(new_turn), max_tokens=4096
+                )
+            include = extract_yes_no(response)
+        return self.apply_segment_decision(new_turn, include)
+
+    def decide_segment_locally(
+        self,
+        new_turn: str,
+    ):
+        """
+        Whether `new_turn` continues the last segment without the LLM, None if the LLM has to decide.
+        """
         assert len(self.memory_bank) > 0, "empty memory bank"
-        last_segment_text = self.memory_bank[-1].page_content
-        prompt = self.incremental_segment_prompt.format(
-            new_turn=new_turn, prev_session=last_segment_text
+        if self.segment_method == "embedding":
+            return self.tiling_segmentor.same_segment(
+                self.memory_bank[-1].metadata["content"], new_turn
+            )
+        if self.segment_gate is None:
+            return None
+        return self.segment_gate.decide(
+            self.memory_bank[-1].metadata["content"], new_turn
         )
-        response = self.segmentor(prompt, max_tokens=4096)
-        include = extract_yes_no(response)
+
+    def incremental_segment_prompt_for(self, new_turn):
+        return self.incremental_segment_prompt.format(
+            new_turn=new_turn, prev_session=self.memory_bank[-1].page_content
+        )
+
+    def apply_segment_decision(
+        self,
+        new_turn: str,
+        include: bool,
+    ):
+        if self.segment_method != "embedding" and self.segment_gate is not None:
+            self.segment_gate.update(include)
         if include:
-            self.memory_bank[-1].page_content += f"\n{new_turn}"
-            self.memory_bank[-1].metadata["content"].append(new_turn)
+            self.memory_bank[-1] = self.extend_memory_unit(
+                self.memory_bank[-1], new_turn
+            )
             replace_last = True
         else:
             self.memory_bank.append(
-                Document(
-                    page_content=new_turn,
-                    metadata={"content": [new_turn], "idx": len(self.memory_bank)},
-                )
+                self.make_memory_unit([new_turn], len(self.memory_bank))
             )
             replace_last = False
         return replace_last
@@ -316,18 +978,100 @@ class SeCom:
         if compress_rate < 1.0 and not self.compressor:
             print("Compressor not initialized, reload compress_rate to 1.0")
             return segments
+        segments = [[seg] if isinstance(seg, str) else seg for seg in segments]
+        exchanges = [exchange for segment in segments for exchange in segment]
+        force_tokens = ["\n", ".", "[human]", "[bot]"]
+        if self.compress_cache is None:
+            comp_exchanges = self.compress_exchanges(
+                exchanges, compress_rate, force_tokens
+            )
+        else:
+            keys = [
+                self.compress_cache.make_compression_key(
+                    exchange, self.compress_model, compress_rate, force_tokens
+                )
+                for exchange in exchanges
+            ]
+            cached = self.compress_cache.get_many(keys)
+            todo = {}
+            for key, exchange in zip(keys, exchanges):
+                if key not in cached:
+                    todo[key] = exchange
+            if todo:
+                comp_todo = self.compress_exchanges(
+                    list(todo.values()), compress_rate, force_tokens
+                )
+                computed = dict(zip(todo, comp_todo))
+                self.compress_cache.set_many(computed)
+                cached.update(computed)
+            comp_exchanges = [cached[key] for key in keys]
+
         comp_segments = []
+        offset = 0
         for segment in segments:
-            comp_segment = self.compressor.compress_prompt(
-                segment,
-                rate=compress_rate,
-                use_context_level_filter=False,
-                force_tokens=["\n", ".", "[human]", "[bot]"],
-            )["compressed_prompt_list"]
-            comp_segments.append(comp_segment)
+            comp_segments.append(comp_exchanges[offset : offset + len(segment)])
+            offset += len(segment)
 
         return comp_segments
 
+    def compress_exchanges(self, exchanges, compress_rate, force_tokens):
+        # LLMLingua-2 compresses every exchange independently, so the exchanges of all units are packed into
+        # full forward batches of the token classifier and scattered back to their units by the caller.
+        comp_exchanges = []
+        for start in range(0, len(exchanges), self.compress_batch_size):
+            comp_exchanges.extend(
+                self.compressor.compress_prompt(
+                    exchanges[start : start + self.compress_batch_size],
+                    rate=compress_rate,
+                    use_context_level_filter=False,
+                    force_tokens=force_tokens,
+                )["compressed_prompt_list"]
+            )
+        return comp_exchanges
+
+    def retrieve_documents(
+        self,
+        requests,
+    ):
+        """
+        Retrieve the top-k memory units for every request.
+
+        With a FAISS vector store all requests are embedded in one batch and searched with a single matrix query,
+            instead of one embedding forward pass and one index search per request.
+
+        Args:
+            requests (List[str]): List of request strings.
+
+        Returns:
+            List[List[Document]]: The retrieved memory units of each request.
+        """
+        if self.embedding_model and self.storage == "FAISS":
+            return self.faiss_batch_search(requests, self.retrieve_topk)
+        if hasattr(self.retriever, "batch_invoke"):
+            return self.retriever.batch_invoke(requests)
+        return [self.retriever.invoke(q) for q in requests]
+
+    def faiss_batch_search(self, requests, topk):
+        import faiss
+        import numpy as np
+
+        from .embeddings import embed_queries
+
+        vectors = np.asarray(embed_queries(self.embeddings, requests), dtype=np.float32)
+        if self.vector_store._normalize_L2:
+            faiss.normalize_L2(vectors)
+        _, indices = self.vector_store.index.search(vectors, topk)
+        r_docs_list = []
+        for row in indices:
+            r_docs = []
+            for i in row:
+                if i == -1:
+                    continue
+                _id = self.vector_store.index_to_docstore_id[i]
+                r_docs.append(self.vector_store.docstore.search(_id))
+            r_docs_list.append(r_docs)
+        return r_docs_list
+
     def retrieve(
         self,
         requests,
@@ -337,19 +1081,15 @@ class SeCom:
         retrieved_n_tokens = []
         n_exchange = 0
         n_token = 0
-        for q in requests:
+        for r_docs in self.retrieve_documents(requests):
             text_list = []
-            r_docs = self.retriever.invoke(q)
             for doc in r_docs:
-                if isinstance(doc.metadata["content"], list):
-                    n_exchange += len(doc.metadata["content"])
-                text = (
-                    "\n".join(doc.metadata["content"])
-                    if isinstance(doc.metadata["content"], list)
-                    else doc.metadata["content"]
-                )
-                text_list.append(text)
-                n_token += len(self.tokenizer.encode(text))
+                text_list.append(self.unit_text(doc.metadata["content"]))
+                if "n_token" not in doc.metadata:
+                    # memory banks saved before the counts were precomputed
+                    self.count_memory_unit(doc)
+                n_exchange += doc.metadata["n_exchange"]
+                n_token += doc.metadata["n_token"]
 
             retrieved_texts.append("\n\n".join(text_list))
             retrieved_n_exs.append(n_exchange)
@@ -360,28 +1100,39 @@ class SeCom:
         return retrieved_texts, n_exchange, n_token
 
     def init_retriever_external_memory(
-        self, memory_bank, topk, storage, embedding_model="", device_map="cuda"
+        self,
+        memory_bank,
+        topk,
+        storage,
+        embedding_model="",
+        device_map="cuda",
+        embedding_cache_dir="",
+        embedding_cache_dtype="float32",
+        storage_kwargs=None,
     ):
         """
         Only for step-by-step experiment.
 
         """
-        from langchain_community.retrievers import BM25Retriever
-        from langchain_community.vectorstores import FAISS, Chroma
-
+        self.retrieve_topk = topk
+        self.storage = storage
         self.embedding_model = embedding_model
+        storage_kwargs = dict(storage_kwargs or {})
         if embedding_model:
-            self.embeddings = HuggingFaceEmbeddings(
-                model_name=embedding_model, model_kwargs={"device": device_map}
+            self.init_embeddings(
+                embedding_model, device_map, embedding_cache_dir, embedding_cache_dtype
             )
-            self.vector_store = (locals()[storage]).from_documents(
+            self.vector_store = get_storage_class(storage).from_documents(
                 memory_bank,
                 self.embeddings,
                 ids=[i for i in range(len(memory_bank))],
+                **storage_kwargs,
             )
             self.retriever = self.vector_store.as_retriever(search_kwargs={"k": topk})
         else:
-            self.retriever = (locals()[storage]).from_documents(memory_bank, k=topk)
+            self.retriever = get_storage_class(storage).from_documents(
+                memory_bank, k=topk, **storage_kwargs
+            )
 
     def retrieve_external_memory(
         self,
@@ -394,53 +1145,15 @@ class SeCom:
         Only for step-by-step experiment.
 
         """
-        if comp_memory_units:
-            memory_bank = [
-                Document(
-                    page_content="\n".join(comp_unit)
-                    if isinstance(comp_unit, list)
-                    else comp_unit,
-                    metadata={"content": unit, "idx": idx},
-                )
-                for idx, (unit, comp_unit) in enumerate(
-                    zip(memory_units, comp_memory_units)
-                )
-            ]
-        else:
-            memory_bank = [
-                Document(
-                    page_content="\n".join(unit) if isinstance(unit, list) else unit,
-                    metadata={"content": unit, "idx": idx},
-                )
-                for idx, unit in enumerate(memory_units)
-            ]
+        if not comp_memory_units:
+            comp_memory_units = memory_units
+        memory_bank = [
+            self.make_memory_unit(unit, idx, comp_unit)
+            for idx, (unit, comp_unit) in enumerate(
+                zip(memory_units, comp_memory_units)
+            )
+        ]
         self.init_retriever_external_memory(
             memory_bank, topk=retrieve_topk, **self.config.retriever
         )
-
-        retrieved_texts = []
-        retrieved_n_exs = []
-        retrieved_n_tokens = []
-        n_exchange = 0
-        n_token = 0
-        for q in requests:
-            text_list = []
-            r_docs = self.retriever.invoke(q)
-            for doc in r_docs:
-                if isinstance(doc.metadata["content"], list):
-                    n_exchange += len(doc.metadata["content"])
-                text = (
-                    "\n".join(doc.metadata["content"])
-                    if isinstance(doc.metadata["content"], list)
-                    else doc.metadata["content"]
-                )
-                text_list.append(text)
-                n_token += len(self.tokenizer.encode(text))
-
-            retrieved_texts.append("\n\n".join(text_list))
-            retrieved_n_exs.append(n_exchange)
-            retrieved_n_tokens.append(n_token)
-
-        n_exchange /= len(requests)
-        n_token /= len(requests)
-        return retrieved_texts, n_exchange, n_token
+        return self.retrieve(requests)
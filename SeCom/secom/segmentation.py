@@ -0,0 +1,267 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class TextTilingSegmentor:
+    """
+    Offline conversation segmentor, TextTiling over the sentence embeddings of the exchanges.
+
+    The similarity between the `window` exchanges before and after every gap gives a similarity curve, and a gap
+        whose valley is deep enough (depth above `mean - depth_std * std` of all gaps and above `min_depth`) becomes
+        a segment boundary. All sessions are embedded in one batch, so segmenting a conversation costs one embedding
+        call instead of one LLM call per session.
+
+    Args:
+        embeddings (Embeddings): The embedding model of the exchanges, e.g. the one of the retriever.
+        window (int, optional): The number of exchanges compared on each side of a gap. Default is 2.
+        depth_std (float, optional): The boundary cutoff below the mean depth, in standard deviations. Default is 0.5.
+        min_depth (float, optional): The minimum depth of a boundary, which keeps coherent sessions whole.
+            Default is 0.1.
+        min_segment_size (int, optional): The minimum number of exchanges per segment. Default is 1.
+        max_segment_size (int, optional): The maximum number of exchanges per segment, longer segments are split at
+            their deepest gap. Default is 0, unlimited.
+        continue_threshold (float, optional): The similarity from which a new exchange continues the last segment,
+            see `same_segment`. Default is 0.5.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        window: int = 2,
+        depth_std: float = 0.5,
+        min_depth: float = 0.1,
+        min_segment_size: int = 1,
+        max_segment_size: int = 0,
+        continue_threshold: float = 0.5,
+    ):
+        self.embeddings = embeddings
+        self.window = window
+        self.depth_std = depth_std
+        self.min_depth = min_depth
+        self.min_segment_size = min_segment_size
+        self.max_segment_size = max_segment_size
+        self.continue_threshold = continue_threshold
+
+    def embed(self, texts: List[str]):
+        vectors = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        return vectors / np.maximum(
+            np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12
+        )
+
+    @staticmethod
+    def cosine(a, b) -> float:
+        return float(a @ b / max(np.linalg.norm(a) * np.linalg.norm(b), 1e-12))
+
+    def gap_similarities(self, vectors):
+        """
+        The block similarity of every gap, gap i lies between exchange i and exchange i + 1.
+        """
+        return np.array(
+            [
+                self.cosine(
+                    vectors[max(0, i + 1 - self.window) : i + 1].mean(axis=0),
+                    vectors[i + 1 : i + 1 + self.window].mean(axis=0),
+                )
+                for i in range(len(vectors) - 1)
+            ]
+        )
+
+    @staticmethod
+    def depth_scores(similarities):
+        depths = np.zeros_like(similarities)
+        for i, similarity in enumerate(similarities):
+            left = i
+            while left > 0 and similarities[left - 1] >= similarities[left]:
+                left -= 1
+            right = i
+            while (
+                right < len(similarities) - 1
+                and similarities[right + 1] >= similarities[right]
+            ):
+                right += 1
+            depths[i] = similarities[left] + similarities[right] - 2 * similarity
+        return depths
+
+    def boundaries(self, vectors) -> List[int]:
+        """
+        Return the sorted gaps after which a new segment starts.
+        """
+        if len(vectors) < 2:
+            return []
+        similarities = self.gap_similarities(vectors)
+        depths = self.depth_scores(similarities)
+        cutoff = max(self.min_depth, depths.mean() - self.depth_std * depths.std())
+        valleys = [
+            i
+            for i in range(len(similarities))
+            if depths[i] > cutoff
+            and (i == 0 or similarities[i] < similarities[i - 1])
+            and (i == len(similarities) - 1 or similarities[i] <= similarities[i + 1])
+        ]
+
+        # deepest valleys first, skipping those that would leave a segment below the minimum size
+        accepted = []
+        for i in sorted(valleys, key=lambda i: -depths[i]):
+            starts = sorted(accepted + [i])
+            edges = [0] + [gap + 1 for gap in starts] + [len(vectors)]
+            if min(b - a for a, b in zip(edges, edges[1:])) >= self.min_segment_size:
+                accepted.append(i)
+        accepted.sort()
+
+        if self.max_segment_size > 0:
+            edges = [-1] + accepted + [len(vectors) - 1]
+            for start, end in zip(edges, edges[1:]):
+                accepted.extend(self._split(depths, start + 1, end))
+            accepted.sort()
+        return accepted
+
+    def _split(self, depths, start, end):
+        # split exchanges [start, end] at their deepest gap until every part fits `max_segment_size`
+        if end - start + 1 <= self.max_segment_size:
+            return []
+        gap = start + int(np.argmax(depths[start:end]))
+        return (
+            [gap] + self._split(depths, start, gap) + self._split(depths, gap + 1, end)
+        )
+
+    def segment(
+        self,
+        exchanges: List[str],
+    ) -> List[List[str]]:
+        return self.segment_sessions([exchanges])
+
+    def segment_sessions(
+        self,
+        sessions: List[List[str]],
+    ) -> List[List[str]]:
+        """
+        Segment each session, return the segments of all sessions in session order like `SeCom.segment`.
+        """
+        texts = [exchange for exchanges in sessions for exchange in exchanges]
+        if not texts:
+            return []
+        vectors = self.embed(texts)
+        segments = []
+        offset = 0
+        for exchanges in sessions:
+            session_vectors = vectors[offset : offset + len(exchanges)]
+            offset += len(exchanges)
+            prev = 0
+            for gap in self.boundaries(session_vectors):
+                segments.append(exchanges[prev : gap + 1])
+                prev = gap + 1
+            if prev < len(exchanges):
+                segments.append(exchanges[prev:])
+        return segments
+
+    def same_segment(
+        self,
+        segment: List[str],
+        new_turn: str,
+    ) -> bool:
+        """
+        Whether a new exchange continues a segment, by its similarity to the last `window` exchanges of the segment.
+        """
+        vectors = self.embed(segment[-self.window :] + [new_turn])
+        return (
+            self.cosine(vectors[:-1].mean(axis=0), vectors[-1])
+            >= self.continue_threshold
+        )
+
+
+class SimilarityGate:
+    """
+    Decides locally whether a new exchange continues the last segment, so that only unclear cases need the LLM.
+
+    The new exchange is compared with the centroid of the last segment's exchange embeddings: a similarity of at
+        least `high_threshold` continues the segment, below `low_threshold` starts a new one, and the band between
+        is escalated to the LLM. The centroid is updated with every decision, so the segment is embedded only once.
+
+    Args:
+        embeddings (Embeddings): The embedding model of the exchanges, e.g. the one of the retriever.
+        low_threshold (float, optional): The similarity below which a new segment starts. Default is 0.2.
+        high_threshold (float, optional): The similarity from which the last segment continues. Default is 0.6.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        low_threshold: float = 0.2,
+        high_threshold: float = 0.6,
+    ):
+        assert low_threshold <= high_threshold, "low_threshold above high_threshold"
+        self.embeddings = embeddings
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+
+        self.n_same = 0
+        self.n_different = 0
+        self.n_escalated = 0
+        self._sum = None
+        self._segment_key = None
+        self._pending = None
+
+    def embed(self, texts: List[str]):
+        vectors = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        return vectors / np.maximum(
+            np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12
+        )
+
+    @staticmethod
+    def _key(segment):
+        return len(segment), segment[0], segment[-1]
+
+    def decide(
+        self,
+        segment: List[str],
+        new_turn: str,
+    ) -> Optional[bool]:
+        """
+        Return True if `new_turn` continues `segment`, False if it starts a new segment, None to ask the LLM.
+
+        Pass the decision that was finally taken to `update`.
+        """
+        if self._segment_key != self._key(segment):
+            # first decision on this segment, e.g. after `build_memory` or `SeCom.load`
+            vectors = self.embed(segment + [new_turn])
+            self._sum = vectors[:-1].sum(axis=0)
+            new_vector = vectors[-1]
+        else:
+            new_vector = self.embed([new_turn])[0]
+        self._pending = (segment, new_turn, new_vector)
+
+        centroid = self._sum / max(np.linalg.norm(self._sum), 1e-12)
+        similarity = float(centroid @ new_vector)
+        if similarity >= self.high_threshold:
+            self.n_same += 1
+            return True
+        if similarity < self.low_threshold:
+            self.n_different += 1
+            return False
+        self.n_escalated += 1
+        return None
+
+    def update(
+        self,
+        include: bool,
+    ):
+        segment, new_turn, new_vector = self._pending
+        self._pending = None
+        if include:
+            self._sum = self._sum + new_vector
+            self._segment_key = self._key(segment + [new_turn])
+        else:
+            self._sum = new_vector.copy()
+            self._segment_key = self._key([new_turn])
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "same": self.n_same,
+            "different": self.n_different,
+            "escalated": self.n_escalated,
+            "llm_calls_avoided": self.n_same + self.n_different,
+        }
@@ -0,0 +1,225 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import contextvars
+import json
+import math
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+_call_site = contextvars.ContextVar("secom_llm_call_site", default="other")
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies in logarithmic buckets, each `growth` times wider than the previous one.
+
+    Memory does not grow with the number of calls, and a percentile is exact up to the relative width of a bucket
+        (5% by default).
+
+    Args:
+        growth (float, optional): The ratio between the bounds of a bucket. Default is 1.05.
+    """
+
+    # latencies below are counted in the first bucket
+    min_latency = 1e-4
+
+    def __init__(
+        self,
+        growth: float = 1.05,
+    ):
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        seconds = max(seconds, 0.0)
+        bucket = int(
+            math.log(max(seconds, self.min_latency) / self.min_latency)
+            / self._log_growth
+        )
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        The `q`-th percentile (0 to 100) of the latencies, the upper bound of its bucket, None if empty.
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(q / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.max, self.min_latency * self.growth ** (bucket + 1))
+        return self.max
+
+    def to_dict(self) -> Dict[str, Optional[float]]:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max if self.count else None,
+        }
+
+
+class CallStats:
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = Counter()
+        self.latency = LatencyHistogram()
+
+    def to_dict(self) -> dict:
+        requests = self.calls + self.cache_hits
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "cache_hit_rate": self.cache_hits / requests if requests else 0.0,
+            "errors": self.errors,
+            "retries": dict(self.retries),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency": self.latency.to_dict(),
+        }
+
+
+class LLMMetrics:
+    """
+    Process-wide accounting of the LLM calls, per model and call site.
+
+    A call site names the purpose of a call, e.g. "segment" (segmenting sessions), "incremental" (deciding whether
+        a new exchange continues the last segment) or "chat" (answering). Callers set it with the `site` context
+        manager, which is inherited by the async tasks started inside it, and the LLM clients record against the
+        current site. For every (model, site) the collector keeps the completed calls with their prompt and
+        completion tokens and a latency histogram, the cache hits, the retries by error class and the calls that
+        failed for good. The latency of a call covers its retries and hedged duplicates, as seen by the caller.
+
+    Example:
+        >>> from secom import llm_metrics
+        >>> with llm_metrics.site("chat"):
+        ...     answer = llm(prompt)
+        >>> llm_metrics.snapshot()["gpt-4o-mini"]["chat"]["latency"]["p95"]
+        >>> llm_metrics.dump("result/llm_metrics.json")
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def site(self, name: str):
+        token = _call_site.set(name)
+        try:
+            yield
+        finally:
+            _call_site.reset(token)
+
+    @staticmethod
+    def current_site() -> str:
+        return _call_site.get()
+
+    def _get(self, model, site) -> CallStats:
+        key = (model, site or self.current_site())
+        if key not in self._stats:
+            self._stats[key] = CallStats()
+        return self._stats[key]
+
+    def record_call(
+        self,
+        model: str,
+        latency: float,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        site: Optional[str] = None,
+    ):
+        """
+        Record a completed call, `site` defaulting to the current call site.
+        """
+        with self._lock:
+            stats = self._get(model, site)
+            stats.calls += 1
+            stats.prompt_tokens += prompt_tokens or 0
+            stats.completion_tokens += completion_tokens or 0
+            stats.latency.add(latency)
+
+    def record_cache_hit(
+        self,
+        model: str,
+        site: Optional[str] = None,
+    ):
+        with self._lock:
+            self._get(model, site).cache_hits += 1
+
+    def record_retry(
+        self,
+        model: str,
+        error: Exception,
+        site: Optional[str] = None,
+    ):
+        from .retry import classify_error
+
+        with self._lock:
+            self._get(model, site).retries[classify_error(error)] += 1
+
+    def record_error(
+        self,
+        model: str,
+        site: Optional[str] = None,
+    ):
+        with self._lock:
+            self._get(model, site).errors += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, dict]]:
+        """
+        The metrics as {model: {site: metrics}}.
+        """
+        with self._lock:
+            metrics = {}
+            for (model, site), stats in sorted(self._stats.items()):
+                metrics.setdefault(model, {})[site] = stats.to_dict()
+            return metrics
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def dump(self, path: str):
+        """
+        Write the snapshot to the JSON file `path`.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(path + ".tmp", path)
+
+
+def completion_usage(completion) -> Tuple[Optional[int], Optional[int]]:
+    """
+    The prompt and completion tokens reported with a chat completion, None if the endpoint reports no usage.
+    """
+    usage = getattr(completion, "usage", None)
+    if usage is None:
+        return None, None
+    return (
+        getattr(usage, "prompt_tokens", None),
+        getattr(usage, "completion_tokens", None),
+    )
+
+
+llm_metrics = LLMMetrics()
@@ -5,25 +5,154 @@ import os
 import os.path as osp
 import re
 from datetime import datetime
-from time import sleep
+from time import monotonic, sleep
 
 from dotenv import load_dotenv
 
+from .telemetry import completion_usage, llm_metrics
+
 
 class OpenAILLM:
-    def __init__(self, model_name="gpt-4o-mini-2024-07-18", disable_reasoning=False):
+    def __init__(
+        self,
+        model_name="gpt-4o-mini-2024-07-18",
+        disable_reasoning=False,
+        cache=None,
+        max_connections=100,
+        max_keepalive_connections=20,
+        keepalive_expiry=30.0,
+        api_keys=None,
+        rpm=None,
+        tpm=None,
+        key_cooldown=1.0,
+        retry_kwargs=None,
+        concurrency=None,
+        timeout=None,
+        hedge=None,
+    ):
+        """
+        Args:
+            model_name (str, optional): The model to call. Default is "gpt-4o-mini-2024-07-18".
+            disable_reasoning (bool, optional): Disable thinking of Qwen models and strip <think> tags. Default is False.
+            cache (LLMResponseCache, optional): The response cache to look up before calling the endpoint.
+                Default is None, always calling the endpoint.
+            max_connections (int, optional): The maximum number of concurrent connections to the endpoint, i.e. of
+                requests in flight, for each of the sync and the async client. Default is 100.
+            max_keepalive_connections (int, optional): The maximum number of idle connections kept open for reuse.
+                Default is 20.
+            keepalive_expiry (float, optional): The number of seconds an idle connection is kept open. Default is 30.
+            api_keys (List[str] | str, optional): The API keys, requests are spread round-robin over all of them.
+                Default is None, the comma-separated keys of the OPENAI_API_KEY environment variable.
+            rpm (float, optional): The requests per minute allowed for each key. Default is None, unlimited.
+            tpm (float, optional): The tokens per minute allowed for each key. Default is None, unlimited.
+            key_cooldown (float, optional): The seconds a key is out of rotation after a rate limit error without
+                `Retry-After`, doubled for every further one before a success. Default is 1.
+            retry_kwargs (dict, optional): The arguments of the `RetryPolicy` of failed requests.
+                Default is None, the default policy.
+            concurrency (dict, optional): The arguments of an `AIMDLimiter` adapting the number of requests in flight
+                to the endpoint, shared by the clients of the same endpoint. Default is None, not limited.
+            timeout (float, optional): The seconds after which a request attempt fails with a timeout and is retried.
+                Default is None, the timeout of the openai client.
+            hedge (dict, optional): The arguments of a `Hedger`, which sends a duplicate of a request that has not
+                returned by the p95 latency. Default is None, not hedged.
+        """
+        import httpx
         from openai import OpenAI
 
+        from .hedging import Hedger
+        from .ratelimit import get_key_pool
+        from .retry import RetryPolicy, get_limiter
+
         self.model_name = model_name
         self.disable_reasoning = disable_reasoning
+        self.cache = cache
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
         load_dotenv(osp.expanduser("~/dot_env/openai.env"))
 
-        self.client = OpenAI()
+        # retries are left to `retry_policy`
+        self.client_options = {"max_retries": 0}
+        if timeout is not None:
+            self.client_options["timeout"] = timeout
+        self.client = OpenAI(
+            http_client=httpx.Client(limits=self.limits), **self.client_options
+        )
         self.client.base_url = os.getenv("OPENAI_API_BASE")
-        keys = os.getenv("OPENAI_API_KEY")
-        self.client.api_key = keys.split(",")[0]
+        keys = api_keys if api_keys is not None else os.getenv("OPENAI_API_KEY")
+        if isinstance(keys, str):
+            keys = keys.split(",")
+        keys = [key.strip() for key in keys if key.strip()]
+        self.client.api_key = keys[0]
+        # one pool per set of keys in the process, so that the per-key budgets hold across SeCom instances
+        self.key_pool = get_key_pool(keys, rpm=rpm, tpm=tpm, cooldown=key_cooldown)
+        self.retry_policy = RetryPolicy(**(retry_kwargs or {}))
+        if len(keys) > 1 and "retry_on" not in (retry_kwargs or {}):
+            # another key may be valid
+            self.retry_policy.retry_on.add("auth")
+        self.concurrency = None
+        if concurrency:
+            # one limiter per endpoint in the process, the load it adapts to is the one of all clients
+            self.concurrency = get_limiter(str(self.client.base_url), **concurrency)
+        self.hedger = Hedger(**hedge) if hedge else None
+        self._key_clients = {}
+        self._async_client = None
+        self._async_loop = None
+        self._async_key_clients = {}
 
-    def __call__(
+    @property
+    def async_client(self):
+        """
+        The `AsyncOpenAI` client of the running event loop, created on first use.
+
+        A pooled connection belongs to the event loop that opened it, so a new client is created when the loop
+            changes, e.g. between two `asyncio.run` calls.
+        """
+        import asyncio
+
+        import httpx
+        from openai import AsyncOpenAI
+
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            self._async_client = AsyncOpenAI(
+                api_key=self.client.api_key,
+                base_url=self.client.base_url,
+                http_client=httpx.AsyncClient(limits=self.limits),
+                **self.client_options,
+            )
+            self._async_loop = loop
+            self._async_key_clients = {}
+        return self._async_client
+
+    def client_for(self, key):
+        # copies of the client share its connection pool
+        if key not in self._key_clients:
+            self._key_clients[key] = self.client.with_options(api_key=key)
+        return self._key_clients[key]
+
+    def async_client_for(self, key):
+        async_client = self.async_client
+        if key not in self._async_key_clients:
+            self._async_key_clients[key] = async_client.with_options(api_key=key)
+        return self._async_key_clients[key]
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+            self._async_loop = None
+            self._async_key_clients = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def make_request(
         self,
         prompt,
         system_prompt=None,
@@ -31,9 +160,7 @@ class OpenAILLM:
         top_p=1.0,
         max_tokens=1024,
         seed=42,
-        max_num_retries=2,
-        return_full=False,
-    ) -> str:
+    ):
         if system_prompt is not None:
             messages = [
                 {
@@ -53,64 +180,274 @@ class OpenAILLM:
                 }
             ]
 
-        retry = 0
-        while retry < max_num_retries:
+        # Build kwargs for API call
+        api_kwargs = {
+            "model": self.model_name,
+            "messages": messages,
+            "temperature": temperature,
+            "top_p": top_p,
+            "max_tokens": max_tokens,
+            "seed": seed,
+        }
+
+        # Disable reasoning for Qwen models if requested
+        if self.disable_reasoning:
+            api_kwargs["extra_body"] = {"enable_thinking": False}
+        return api_kwargs
+
+    def make_response(
+        self,
+        prompt,
+        system_prompt,
+        temperature,
+        max_tokens,
+        content,
+        return_full=False,
+    ):
+        if not return_full:
+            return content
+
+        ret_dict = {
+            "prompt": prompt,
+            "system_prompt": system_prompt,
+            "model_name": self.model_name,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "response": content,
+            "response_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            # "completion_obj": completion,
+        }
+        return ret_dict
+
+    def __call__(
+        self,
+        prompt,
+        system_prompt=None,
+        temperature=0.7,
+        top_p=1.0,
+        max_tokens=1024,
+        seed=42,
+        max_num_retries=None,
+        return_full=False,
+    ) -> str:
+        api_kwargs = self.make_request(
+            prompt, system_prompt, temperature, top_p, max_tokens, seed
+        )
+        cache_key = None
+        content = None
+        if self.cache is not None:
+            cache_key = self.cache.make_request_key(api_kwargs)
+            content = self.cache.get(cache_key)
+            if content is not None:
+                llm_metrics.record_cache_hit(self.model_name)
+        if content is None:
+            content = self.complete(api_kwargs, max_num_retries)
+            if cache_key is not None:
+                self.cache.set(cache_key, content)
+        return self.make_response(
+            prompt, system_prompt, temperature, max_tokens, content, return_full
+        )
+
+    async def acall(
+        self,
+        prompt,
+        system_prompt=None,
+        temperature=0.7,
+        top_p=1.0,
+        max_tokens=1024,
+        seed=42,
+        max_num_retries=None,
+        return_full=False,
+    ) -> str:
+        """
+        The async counterpart of `__call__`, so that one process keeps many requests in flight over the pooled
+            connections of `async_client`.
+        """
+        api_kwargs = self.make_request(
+            prompt, system_prompt, temperature, top_p, max_tokens, seed
+        )
+        cache_key = None
+        content = None
+        if self.cache is not None:
+            cache_key = self.cache.make_request_key(api_kwargs)
+            content = self.cache.get(cache_key)
+            if content is not None:
+                llm_metrics.record_cache_hit(self.model_name)
+        if content is None:
+            content = await self.acomplete(api_kwargs, max_num_retries)
+            if cache_key is not None:
+                self.cache.set(cache_key, content)
+        return self.make_response(
+            prompt, system_prompt, temperature, max_tokens, content, return_full
+        )
+
+    def complete(self, api_kwargs, max_num_retries=None):
+        """
+        Request a completion, retrying failed attempts by `retry_policy`, at most `max_num_retries` attempts in
+            total (default by the policy). The call is recorded in `llm_metrics` under the current call site.
+        """
+        start = monotonic()
+        attempt = 0
+        while True:
             try:
-                # Build kwargs for API call
-                api_kwargs = {
-                    "model": self.model_name,
-                    "messages": messages,
-                    "temperature": temperature,
-                    "top_p": top_p,
-                    "max_tokens": max_tokens,
-                    "seed": seed,
-                }
-                
-                # Disable reasoning for Qwen models if requested
-                if self.disable_reasoning:
-                    api_kwargs["extra_body"] = {"enable_thinking": False}
-                
-                completion = self.client.chat.completions.create(**api_kwargs)
-                content = completion.choices[0].message.content
-                
-                # Strip <think>...</think> tags if disable_reasoning is enabled
-                if self.disable_reasoning and content:
-                    # Remove everything between <think> and </think> (including tags)
-                    original_content = content
-                    content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
-                    content = content.strip()
-                    if not content:
-                        print(f"[WARNING] After stripping <think> tags, content is empty!")
-                        print(f"[DEBUG] Original length: {len(original_content)}, After strip: {len(content)}")
-                
-                if not return_full:
-                    return content
-
-                ret_dict = {
-                    "prompt": prompt,
-                    "system_prompt": system_prompt,
-                    "model_name": self.model_name,
-                    "temperature": temperature,
-                    "max_tokens": max_tokens,
-                    "response": content,
-                    "response_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    # "completion_obj": completion,
-                }
-                return ret_dict
+                if self.hedger is None:
+                    completion = self.request(api_kwargs)
+                else:
+                    completion = self.hedger.run(
+                        self.request,
+                        api_kwargs,
+                        size=request_size(api_kwargs),
+                        cost=self.key_pool.estimate_tokens(api_kwargs),
+                        admit=self.can_hedge,
+                        usage=usage_tokens,
+                    )
+            except Exception as e:
+                sleep(self.retry_delay(e, attempt, max_num_retries))
+                attempt += 1
+                continue
+            llm_metrics.record_call(
+                self.model_name,
+                monotonic() - start,
+                *completion_usage(completion),
+            )
+            return self.strip_reasoning(completion.choices[0].message.content)
+
+    async def acomplete(self, api_kwargs, max_num_retries=None):
+        import asyncio
 
+        start = monotonic()
+        attempt = 0
+        while True:
+            try:
+                if self.hedger is None:
+                    completion = await self.arequest(api_kwargs)
+                else:
+                    completion = await self.hedger.arun(
+                        self.arequest,
+                        api_kwargs,
+                        size=request_size(api_kwargs),
+                        cost=self.key_pool.estimate_tokens(api_kwargs),
+                        admit=self.can_hedge,
+                        usage=usage_tokens,
+                    )
             except Exception as e:
-                retry += 1
-                sleep(5)
-                print(f"Error: {e}", flush=True)
+                await asyncio.sleep(self.retry_delay(e, attempt, max_num_retries))
+                attempt += 1
+                continue
+            llm_metrics.record_call(
+                self.model_name,
+                monotonic() - start,
+                *completion_usage(completion),
+            )
+            return self.strip_reasoning(completion.choices[0].message.content)
 
-        raise RuntimeError(
-            "Calling OpenAI failed after retrying for " f"{retry} times."
-        )
+    def request(self, api_kwargs):
+        """
+        One attempt of a request, with a key of the key pool and a slot of the concurrency limiter.
+        """
+        n_tokens = self.key_pool.estimate_tokens(api_kwargs)
+        key = self.key_pool.acquire(n_tokens)
+        if self.concurrency is not None:
+            self.concurrency.acquire()
+        try:
+            completion = self.client_for(key).chat.completions.create(**api_kwargs)
+        except Exception as e:
+            self.report_error(key, e)
+            raise
+        except BaseException:
+            # interrupted or cancelled, which says nothing about the endpoint
+            if self.concurrency is not None:
+                self.concurrency.release(adapt=False)
+            raise
+        if self.concurrency is not None:
+            self.concurrency.release()
+        self.key_pool.record_usage(key, n_tokens, usage_tokens(completion))
+        return completion
+
+    async def arequest(self, api_kwargs):
+        n_tokens = self.key_pool.estimate_tokens(api_kwargs)
+        key = await self.key_pool.aacquire(n_tokens)
+        if self.concurrency is not None:
+            await self.concurrency.aacquire()
+        try:
+            completion = await self.async_client_for(key).chat.completions.create(
+                **api_kwargs
+            )
+        except Exception as e:
+            self.report_error(key, e)
+            raise
+        except BaseException:
+            # interrupted or cancelled, e.g. the losing request of a hedge
+            if self.concurrency is not None:
+                self.concurrency.release(adapt=False)
+            raise
+        if self.concurrency is not None:
+            self.concurrency.release()
+        self.key_pool.record_usage(key, n_tokens, usage_tokens(completion))
+        return completion
+
+    def can_hedge(self):
+        # a hedge is an extra request in flight, never sent while the endpoint is at its concurrency limit
+        return self.concurrency is None or self.concurrency.has_capacity()
+
+    def report_error(self, key, error):
+        if self.concurrency is not None:
+            self.concurrency.release(error)
+        self.key_pool.report_error(key, error)
+
+    def retry_delay(self, error, attempt, max_num_retries=None):
+        """
+        Return the seconds to wait before the next attempt after a failed one, raise if it is not retried.
+        """
+        from .retry import classify_error
+
+        if not self.retry_policy.should_retry(error, attempt, max_num_retries):
+            llm_metrics.record_error(self.model_name)
+            raise RuntimeError(
+                f"Calling OpenAI failed after {attempt + 1} attempts."
+            ) from error
+        self.retry_policy.record(error)
+        llm_metrics.record_retry(self.model_name, error)
+        error_class = classify_error(error)
+        if error_class in ("rate_limit", "auth") and len(self.key_pool.keys) > 1:
+            # the key pool waits for the key, or moves on to another one
+            delay = 0.0
+        else:
+            delay = self.retry_policy.delay(attempt, error)
+        print(f"Error ({error_class}): {error}, retrying in {delay:.1f}s", flush=True)
+        return delay
+
+    def stats(self):
+        """
+        The counters of the key pool, the retries, the concurrency limiter and the hedged requests.
+        """
+        return {
+            "keys": self.key_pool.stats(),
+            "retries": self.retry_policy.stats(),
+            "concurrency": self.concurrency.stats() if self.concurrency else None,
+            "hedging": self.hedger.stats() if self.hedger else None,
+        }
+
+    def strip_reasoning(self, content):
+        # Strip <think>...</think> tags if disable_reasoning is enabled
+        if self.disable_reasoning and content:
+            # Remove everything between <think> and </think> (including tags)
+            original_content = content
+            content = re.sub(r"<think>.*?</think>", "", content, flags=re.DOTALL)
+            content = content.strip()
+            if not content:
+                print(f"[WARNING] After stripping <think> tags, content is empty!")
+                print(
+                    f"[DEBUG] Original length: {len(original_content)}, After strip: {len(content)}"
+                )
+        return content
 
 
 class LocalLLM:
     def __init__(self, model_name_or_path):
         from vllm import LLM
+
+        self.model_name = model_name_or_path
         self.model = LLM(model=model_name_or_path)
 
     def __call__(
@@ -126,10 +463,26 @@ class LocalLLM:
         sampling_params = SamplingParams(
             temperature=temperature, top_p=top_p, max_tokens=max_tokens, seed=seed
         )
+        start = monotonic()
         outputs = self.model.generate(prompt, sampling_params)
+        llm_metrics.record_call(
+            self.model_name,
+            monotonic() - start,
+            len(outputs[0].prompt_token_ids or []),
+            len(outputs[0].outputs[0].token_ids),
+        )
         return outputs[0].outputs[0].text
 
 
+def request_size(api_kwargs):
+    return sum(len(str(m.get("content", ""))) for m in api_kwargs["messages"])
+
+
+def usage_tokens(completion):
+    usage = getattr(completion, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
 def extract_result(text, tag="tag"):
     pattern = rf"<{tag}>([\s\S]*?)<\/{tag}>"
     matches = re.findall(pattern, text)
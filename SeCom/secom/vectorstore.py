@@ -0,0 +1,595 @@
+# Copyright (c) 2024 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+
+import json
+import math
+import os
+import tempfile
+from typing import TYPE_CHECKING, List, Optional
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from langchain_core.documents import Document
+
+# faiss scalar quantizer matching each storage dtype, so an approximate index does not undo the saving
+FAISS_ENCODINGS = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}
+
+
+class FlatVectorStore:
+    """
+    Dot-product vector store over one contiguous matrix, with optional quantization and approximate search.
+
+    Rows are kept in a preallocated matrix that grows geometrically, so appending a memory unit is amortized
+        constant time and replacing a memory unit overwrites its row in place. A batch of queries is scored with a
+        single matrix product and the top-k is selected with `argpartition`, which suits the small per-conversation
+        memory banks better than a langchain vector store.
+
+    With `dtype` "float16" or "int8" (symmetric, one float32 scale per row) the matrix takes 1/2 or 1/4 of the
+        float32 memory. With `rescore`, the float32 vectors are also kept in a memory-mapped file in `rescore_dir`,
+        outside the process heap, and the best `rescore_factor * k` candidates of the quantized search are rescored
+        with them. That file is larger than the quantized matrix and is reported by `rescore_usage`, not
+        `memory_usage`, so `rescore_dir` must be on disk: a tmpfs directory such as /tmp on many systems is RAM.
+
+    With `index_type` "hnsw" or "ivf", banks of at least `ann_threshold` rows are searched through a faiss index
+        instead. The newest rows stay in an exact tail of up to `ann_buffer` rows and are inserted into the index in
+        batches, so the last memory unit, which `update_memory` keeps replacing, never has to be removed from it.
+        Candidates of the index and the tail are rescored against the matrix.
+
+    Args:
+        embedding (Embeddings): The embedding model of documents and queries.
+        normalize (bool, optional): Normalize all vectors, so that the dot product is the cosine similarity.
+            Default is False, the raw dot product.
+        initial_capacity (int, optional): The number of rows preallocated before the first growth. Default is 64.
+        dtype (str, optional): The storage dtype, "float32", "float16" or "int8". Default is "float32".
+        rescore (bool, optional): Rescore the top candidates of a quantized matrix with float32 vectors.
+            Default is False.
+        rescore_factor (int, optional): The number of candidates rescored per retrieved document. Default is 4.
+        rescore_dir (str, optional): The directory on disk of the float32 memory map, required with `rescore`.
+            Default is "".
+        index_type (str, optional): "flat" for exact search only, "hnsw" or "ivf" for approximate search above
+            `ann_threshold`. Default is "flat".
+        ann_threshold (int, optional): The number of rows from which approximate search is used. Default is 10000.
+        ann_buffer (int, optional): The maximum number of newest rows searched exactly before they are inserted
+            into the approximate index. Default is 256.
+        hnsw_m (int, optional): HNSW graph degree, higher is more accurate and uses more memory. Default is 32.
+        ef_construction (int, optional): HNSW build-time beam width. Default is 80.
+        ef_search (int, optional): HNSW query-time beam width, the recall/latency knob. Default is 64.
+        nlist (int, optional): The number of IVF clusters. Default is 0, 4 * sqrt(number of rows), at most 1/39 of it.
+        nprobe (int, optional): The number of IVF clusters visited per query, the recall/latency knob. Default is 16.
+    """
+
+    def __init__(
+        self,
+        embedding,
+        normalize: bool = False,
+        initial_capacity: int = 64,
+        dtype: str = "float32",
+        rescore: bool = False,
+        rescore_factor: int = 4,
+        rescore_dir: str = "",
+        index_type: str = "flat",
+        ann_threshold: int = 10000,
+        ann_buffer: int = 256,
+        hnsw_m: int = 32,
+        ef_construction: int = 80,
+        ef_search: int = 64,
+        nlist: int = 0,
+        nprobe: int = 16,
+    ):
+        assert dtype in FAISS_ENCODINGS, f"unsupported dtype {dtype}"
+        assert index_type in ("flat", "hnsw", "ivf"), f"unknown index_type {index_type}"
+        self.embedding = embedding
+        self.normalize = normalize
+        self.initial_capacity = initial_capacity
+        self.dtype = dtype
+        # float32 rows are exact already, there is nothing to rescore
+        self.rescore = rescore and dtype != "float32"
+        self.rescore_factor = rescore_factor
+        self.rescore_dir = rescore_dir
+        assert (
+            not self.rescore or rescore_dir
+        ), "rescore needs rescore_dir, a directory on disk"
+        self.index_type = index_type
+        self.ann_threshold = ann_threshold
+        self.ann_buffer = ann_buffer
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.nlist = nlist
+        self.nprobe = nprobe
+
+        self.docs = []
+        self.ids = []
+        self._vectors = None
+        self._scales = None
+        self._full = None
+        # the approximate index holds rows [0, _n_indexed), labelled by their row position
+        self._ann = None
+        self._n_indexed = 0
+        self._n_trained = 0
+
+    @classmethod
+    def from_documents(
+        cls,
+        documents: List["Document"],
+        embedding,
+        ids: Optional[List] = None,
+        **kwargs,
+    ):
+        store = cls(embedding, **kwargs)
+        store.add_documents(documents, ids=ids)
+        return store
+
+    def __len__(self):
+        return len(self.docs)
+
+    @property
+    def vectors(self):
+        """
+        The float32 vectors of all rows, dequantized if the matrix is quantized.
+        """
+        if self._vectors is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._decode(slice(0, len(self.docs)))
+
+    def _as_matrix(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.normalize:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+        return vectors
+
+    def _decode(self, rows):
+        vectors = self._vectors[rows]
+        if self.dtype == "float32":
+            return vectors
+        vectors = vectors.astype(np.float32)
+        if self.dtype == "int8":
+            vectors *= self._scales[rows][..., None]
+        return vectors
+
+    def _write(self, rows, vectors):
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self._scales[rows] = scales
+            self._vectors[rows] = np.rint(vectors / scales[:, None])
+        else:
+            self._vectors[rows] = vectors
+        if self.rescore:
+            self._full[rows] = vectors
+
+    def _reserve(self, n_rows, dim):
+        if self._vectors is not None:
+            if n_rows <= len(self._vectors):
+                return
+            assert dim == self._vectors.shape[1], "embedding dimension changed"
+        n = len(self.docs)
+        capacity = max(self.initial_capacity, n_rows)
+        if self._vectors is not None:
+            capacity = max(2 * len(self._vectors), n_rows)
+        vectors = np.zeros((capacity, dim), dtype=self.dtype)
+        if self._vectors is not None:
+            vectors[:n] = self._vectors[:n]
+        self._vectors = vectors
+        if self.dtype == "int8":
+            scales = np.ones(capacity, dtype=np.float32)
+            if self._scales is not None:
+                scales[:n] = self._scales[:n]
+            self._scales = scales
+        if self.rescore:
+            os.makedirs(self.rescore_dir, exist_ok=True)
+            fd, path = tempfile.mkstemp(suffix=".f32", dir=self.rescore_dir)
+            os.close(fd)
+            full = np.memmap(path, dtype=np.float32, mode="w+", shape=(capacity, dim))
+            # the mapping keeps the file alive, it is freed with the store
+            os.remove(path)
+            if self._full is not None:
+                full[:n] = self._full[:n]
+            self._full = full
+
+    def add_documents(
+        self,
+        documents: List["Document"],
+        ids: Optional[List] = None,
+    ) -> List:
+        if not documents:
+            return []
+        vectors = self._as_matrix(
+            self.embedding.embed_documents([doc.page_content for doc in documents])
+        )
+        return self.add_vectors(documents, vectors, ids=ids)
+
+    def add_vectors(
+        self,
+        documents: List["Document"],
+        vectors,
+        ids: Optional[List] = None,
+    ) -> List:
+        """
+        Append documents with precomputed (and, if `normalize` is set, normalized) float32 vectors.
+        """
+        n = len(self.docs)
+        if ids is None:
+            ids = list(range(n, n + len(documents)))
+        self._reserve(n + len(documents), vectors.shape[1])
+        self._write(slice(n, n + len(documents)), vectors)
+        self.docs.extend(documents)
+        self.ids.extend(ids)
+        return list(ids)
+
+    def replace_document(
+        self,
+        idx: int,
+        doc: "Document",
+    ):
+        """
+        Replace the document at position `idx` and overwrite its row in place, e.g. -1 for the last memory unit.
+        """
+        idx %= len(self.docs)
+        vectors = self._as_matrix(self.embedding.embed_documents([doc.page_content]))
+        self._write(slice(idx, idx + 1), vectors)
+        self.docs[idx] = doc
+        if idx < self._n_indexed:
+            # approximate indexes cannot update a vector, rebuild on the next search
+            self._reset_ann()
+
+    def update_documents(
+        self,
+        start: int,
+        documents: List["Document"],
+    ):
+        """
+        Replace the documents from position `start` on and append the ones beyond the end, with one embedding call
+            made before anything changes.
+        """
+        if not documents:
+            return
+        vectors = self._as_matrix(
+            self.embedding.embed_documents([doc.page_content for doc in documents])
+        )
+        n_replaced = max(0, min(len(documents), len(self.docs) - start))
+        if n_replaced:
+            self._write(slice(start, start + n_replaced), vectors[:n_replaced])
+            for i, doc in enumerate(documents[:n_replaced]):
+                self.docs[start + i] = doc
+            if start < self._n_indexed:
+                self._reset_ann()
+        if n_replaced < len(documents):
+            self.add_vectors(documents[n_replaced:], vectors[n_replaced:])
+
+    def delete(
+        self,
+        ids: List,
+    ):
+        drop = set(ids)
+        keep = [i for i, _id in enumerate(self.ids) if _id not in drop]
+        if len(keep) == len(self.docs):
+            return
+        self._vectors[: len(keep)] = self._vectors[keep]
+        if self.dtype == "int8":
+            self._scales[: len(keep)] = self._scales[keep]
+        if self.rescore:
+            self._full[: len(keep)] = self._full[keep]
+        self.docs = [self.docs[i] for i in keep]
+        self.ids = [self.ids[i] for i in keep]
+        self._reset_ann()
+
+    def _reset_ann(self):
+        self._ann = None
+        self._n_indexed = 0
+        self._n_trained = 0
+
+    def _configure_ann(self):
+        import faiss
+
+        if self.index_type == "hnsw":
+            faiss.downcast_index(self._ann).hnsw.efSearch = self.ef_search
+        else:
+            faiss.extract_index_ivf(self._ann).nprobe = self.nprobe
+
+    def _sync_ann(self) -> bool:
+        """
+        Bring the approximate index up to date, return whether approximate search is used.
+        """
+        n = len(self.docs)
+        if self.index_type == "flat" or n < self.ann_threshold:
+            return False
+        import faiss
+
+        if self.index_type == "ivf" and n > 4 * self._n_trained:
+            # the clusters were trained on a much smaller bank, retrain them
+            self._reset_ann()
+        if self._ann is None:
+            dim = self._vectors.shape[1]
+            encoding = FAISS_ENCODINGS[self.dtype]
+            if self.index_type == "hnsw":
+                factory = f"HNSW{self.hnsw_m},{encoding}"
+            else:
+                # faiss wants at least 39 training points per cluster
+                nlist = self.nlist or max(1, min(int(4 * math.sqrt(n)), n // 39))
+                factory = f"IVF{nlist},{encoding}"
+            self._ann = faiss.index_factory(dim, factory, faiss.METRIC_INNER_PRODUCT)
+            if self.index_type == "hnsw":
+                faiss.downcast_index(
+                    self._ann
+                ).hnsw.efConstruction = self.ef_construction
+            if not self._ann.is_trained:
+                self._ann.train(self._decode(slice(0, n)))
+                self._n_trained = n
+            self._configure_ann()
+        # the last row stays in the exact tail, it is the one replaced by `update_memory`
+        if n - 1 - self._n_indexed >= self.ann_buffer or self._n_indexed == 0:
+            self._ann.add(self._decode(slice(self._n_indexed, n - 1)))
+            self._n_indexed = n - 1
+        return True
+
+    def _scores(self, queries, block_size=4096):
+        # dequantize block by block, so that a quantized matrix is never expanded to float32 as a whole
+        if self.dtype == "float32":
+            return queries @ self._vectors[: len(self.docs)].T
+        n = len(self.docs)
+        scores = np.empty((len(queries), n), dtype=np.float32)
+        for start in range(0, n, block_size):
+            rows = slice(start, min(start + block_size, n))
+            scores[:, rows] = queries @ self._decode(rows).T
+        return scores
+
+    def search_by_vectors(
+        self,
+        queries,
+        k: int,
+    ):
+        """
+        Top-k search of a batch of query vectors.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The (n_query, k) row indices and scores, best first.
+        """
+        queries = self._as_matrix(queries)
+        k = min(k, len(self.docs))
+        if k == 0:
+            return (
+                np.zeros((len(queries), 0), dtype=np.int64),
+                np.zeros((len(queries), 0), dtype=np.float32),
+            )
+        n_candidates = k * self.rescore_factor if self.rescore else k
+        if self._sync_ann():
+            # candidates of the approximate index plus the exact tail, rescored against the matrix
+            _, candidates = self._ann.search(queries, n_candidates)
+            tail = np.arange(self._n_indexed, len(self.docs))
+            candidates = np.concatenate(
+                [candidates, np.broadcast_to(tail, (len(queries), len(tail)))], axis=1
+            )
+            # the index pads with -1 when the probed cells hold fewer rows than asked for
+            valid = candidates >= 0
+            candidates = np.where(valid, candidates, 0)
+            scores = np.einsum("qd,qcd->qc", queries, self._decode(candidates))
+            scores[~valid] = -np.inf
+            top, _ = self._select_topk(
+                scores, min(n_candidates, scores.shape[1], len(self.docs))
+            )
+            candidates = np.take_along_axis(candidates, top, axis=1)
+            valid = np.take_along_axis(valid, top, axis=1)
+            short = valid.sum(axis=1) < k
+            if short.any():
+                # too few distinct rows in the probed cells, these queries are searched exactly
+                candidates[short], _ = self._select_topk(
+                    self._scores(queries[short]), candidates.shape[1]
+                )
+                valid[short] = True
+        elif self.rescore:
+            candidates, _ = self._select_topk(
+                self._scores(queries), min(n_candidates, len(self.docs))
+            )
+            valid = None
+        else:
+            return self._select_topk(self._scores(queries), k)
+        if self.rescore:
+            scores = np.einsum("qd,qcd->qc", queries, self._full[candidates])
+        else:
+            scores = np.einsum("qd,qcd->qc", queries, self._decode(candidates))
+        if valid is not None:
+            # padded slots never outrank a real row, every query has at least k of them
+            scores[~valid] = -np.inf
+        top, top_scores = self._select_topk(scores, k)
+        return np.take_along_axis(candidates, top, axis=1), top_scores
+
+    @staticmethod
+    def _select_topk(scores, k):
+        if k < scores.shape[1]:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        return (
+            np.take_along_axis(top, order, axis=1),
+            np.take_along_axis(top_scores, order, axis=1),
+        )
+
+    def batch_search(
+        self,
+        queries: List[str],
+        k: int,
+    ) -> List[List["Document"]]:
+        """
+        Embed all queries and retrieve the top-k documents of each with a single matrix product.
+        """
+        from .embeddings import embed_queries
+
+        if not queries:
+            return []
+        rows, _ = self.search_by_vectors(embed_queries(self.embedding, queries), k)
+        return [[self.docs[i] for i in row] for row in rows]
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 3,
+    ) -> List["Document"]:
+        rows, _ = self.search_by_vectors([self.embedding.embed_query(query)], k)
+        return [self.docs[i] for i in rows[0]]
+
+    def as_retriever(
+        self,
+        search_kwargs: Optional[dict] = None,
+    ):
+        return FlatRetriever(self, k=(search_kwargs or {}).get("k", 3))
+
+    def save_local(
+        self,
+        folder_path: str,
+    ):
+        """
+        Save the store as numpy matrices and a `MappedDocumentStore`, which `load_local` maps without parsing.
+        """
+        from .docstore import MappedDocumentStore, save_array
+
+        os.makedirs(folder_path, exist_ok=True)
+        n = len(self.docs)
+        if self._vectors is not None:
+            save_array(os.path.join(folder_path, "vectors.npy"), self._vectors[:n])
+            if self.dtype == "int8":
+                save_array(os.path.join(folder_path, "scales.npy"), self._scales[:n])
+            if self.rescore:
+                save_array(os.path.join(folder_path, "full.npy"), self._full[:n])
+        MappedDocumentStore.write(os.path.join(folder_path, "docs"), self.docs)
+        with open(os.path.join(folder_path, "ids.json"), "w", encoding="utf-8") as f:
+            json.dump(list(self.ids), f)
+        config = {
+            key: getattr(self, key)
+            for key in [
+                "normalize",
+                "dtype",
+                "rescore",
+                "rescore_factor",
+                "rescore_dir",
+                "index_type",
+                "ann_threshold",
+                "ann_buffer",
+                "hnsw_m",
+                "ef_construction",
+                "ef_search",
+                "nlist",
+                "nprobe",
+            ]
+        }
+        ann_path = os.path.join(folder_path, "ann.index")
+        if self._ann is not None:
+            import faiss
+
+            faiss.write_index(self._ann, ann_path + ".tmp")
+            os.replace(ann_path + ".tmp", ann_path)
+            config.update(n_indexed=self._n_indexed, n_trained=self._n_trained)
+        elif os.path.exists(ann_path):
+            os.remove(ann_path)
+        with open(os.path.join(folder_path, "store.json"), "w", encoding="utf-8") as f:
+            json.dump(config, f, indent=2)
+
+    @classmethod
+    def load_local(
+        cls,
+        folder_path: str,
+        embeddings,
+        allow_dangerous_deserialization: bool = False,
+        mmap: bool = True,
+        **kwargs,
+    ):
+        """
+        Restore a store saved by `save_local`. `kwargs` override the saved settings, e.g. `ef_search` or `nprobe`.
+
+        With `mmap`, the matrices and the documents are read from copy-on-write memory maps instead of being loaded,
+            so worker processes restoring the same snapshot share one page-cached copy. Rows replaced afterwards are
+            copied privately, and the first append beyond the saved rows moves the matrix to memory.
+        """
+        from .docstore import MappedDocumentStore
+
+        with open(os.path.join(folder_path, "store.json"), "r", encoding="utf-8") as f:
+            config = json.load(f)
+        n_indexed = config.pop("n_indexed", 0)
+        n_trained = config.pop("n_trained", 0)
+        if not config.get("rescore_dir"):
+            # saved before rescore_dir was stored, the rows appended after loading go next to the snapshot
+            config["rescore_dir"] = folder_path
+        store = cls(embeddings, **{**config, **kwargs})
+        docs = MappedDocumentStore(os.path.join(folder_path, "docs"))
+        with open(os.path.join(folder_path, "ids.json"), "r", encoding="utf-8") as f:
+            ids = json.load(f)
+        if len(docs) == 0:
+            return store
+
+        def load(name):
+            return np.load(
+                os.path.join(folder_path, name), mmap_mode="c" if mmap else None
+            )
+
+        vectors = load("vectors.npy")
+        scales = load("scales.npy") if config["dtype"] == "int8" else None
+        full = load("full.npy") if config["rescore"] else None
+        if store.dtype == config["dtype"] and store.rescore == config["rescore"]:
+            store._vectors, store._scales, store._full = vectors, scales, full
+        else:
+            # the storage format was overridden, quantize the saved vectors again
+            if full is None:
+                full = vectors.astype(np.float32)
+                if scales is not None:
+                    full *= scales[:, None]
+            store._reserve(len(docs), full.shape[1])
+            store._write(slice(0, len(docs)), np.asarray(full, dtype=np.float32))
+        store.docs = docs
+        store.ids = ids
+
+        if (
+            n_indexed
+            and store.index_type == config["index_type"]
+            and store.dtype == config["dtype"]
+        ):
+            import faiss
+
+            store._ann = faiss.read_index(os.path.join(folder_path, "ann.index"))
+            store._n_indexed = n_indexed
+            store._n_trained = n_trained
+            store._configure_ann()
+        return store
+
+    def memory_usage(self) -> int:
+        # documents are shared with the memory bank or memory-mapped, and so are the matrices restored by
+        # `load_local`, which live in the page cache; the float32 vectors of `rescore` are counted by `rescore_usage`
+        if self._vectors is None:
+            return 0
+        n_bytes = 8 * len(self.ids)
+        if not isinstance(self._vectors, np.memmap):
+            n_bytes += self._vectors.nbytes
+            if self.dtype == "int8":
+                n_bytes += self._scales.nbytes
+        if self._ann is not None:
+            # the approximate index keeps its own (equally quantized) copy of the vectors, plus the graph links
+            # or the inverted lists
+            per_row = self._vectors.shape[1] * self._vectors.itemsize
+            per_row += 8 * self.hnsw_m if self.index_type == "hnsw" else 8
+            n_bytes += self._n_indexed * per_row
+        return n_bytes
+
+    def rescore_usage(self) -> int:
+        """
+        The bytes of the float32 vectors kept for `rescore`, in a file of `rescore_dir` or a restored snapshot.
+        """
+        return self._full.nbytes if self._full is not None else 0
+
+
+class FlatRetriever:
+    """
+    Top-k retriever over a `FlatVectorStore` or a `HybridStore`, with the `invoke` interface of langchain retrievers.
+    """
+
+    def __init__(self, vector_store: FlatVectorStore, k: int = 3):
+        self.vector_store = vector_store
+        self.k = k
+
+    def invoke(self, query: str) -> List["Document"]:
+        return self.vector_store.similarity_search(query, k=self.k)
+
+    def batch_invoke(self, queries: List[str]) -> List[List["Document"]]:
+        return self.vector_store.batch_search(queries, k=self.k)
@@ -4,7 +4,7 @@ os.environ["OPENAI_API_BASE"] = "http://localhost:8001/v1"
 
 SEGMENT_MODEL = "Qwen/Qwen3-8B"
 
-from SeCom.secom import SeCom
+from SeCom.secom import SeCom, llm_metrics
 
 mm = SeCom(
     granularity="segment",
@@ -68,4 +68,6 @@ segments = mm.segment(sessions)
 print("="*50)
 print("FINAL SEGMENTS:")
 print("="*50)
-print(segments)
\ No newline at end of file
+print(segments)
+llm_metrics.dump("llm_metrics.json")
+print(llm_metrics.snapshot())
@@ -11,6 +11,8 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from topic_segmentation import segment_dialogue_with_llm, get_openai_client
+from SeCom.secom.retry import RetryPolicy
+from SeCom.secom.telemetry import llm_metrics
 
 client = get_openai_client()
 
@@ -20,7 +22,9 @@ def process_single_conversation(
     model: str = "gpt-4o",
     temperature: float = 0.3,
     retry_delay: float = 1.0,
-    max_retries: int = 3
+    max_retries: int = 3,
+    cache=None,
+    retry_policy=None
 ) -> Dict[str, Any]:
     """
     Process a single conversation with retry logic.
@@ -29,8 +33,11 @@ def process_single_conversation(
         conv: Conversation data
         model: OpenAI model to use
         temperature: Temperature for generation
-        retry_delay: Delay between retries (seconds)
-        max_retries: Maximum number of retries
+        retry_delay: Base delay of the exponential backoff between retries (seconds)
+        max_retries: Maximum number of attempts per session
+        cache: Optional LLMResponseCache shared by all segmentation calls
+        retry_policy: Optional RetryPolicy shared by all segmentation calls, built from
+            retry_delay and max_retries if not given
         
     Returns:
         Processed conversation with segments
@@ -40,6 +47,12 @@ def process_single_conversation(
     dialogs = conv.get("dialogs", [])
     
     segmented_dialogs = []
+    if retry_policy is None:
+        retry_policy = RetryPolicy(
+            max_attempts=max_retries,
+            base_delay=retry_delay,
+            on_retry=lambda e: llm_metrics.record_retry(model, e, site="segment")
+        )
     
     for dialog in dialogs:
         session_id = dialog.get("session_id", "unknown")
@@ -55,31 +68,17 @@ def process_single_conversation(
             })
             continue
         
-        segments = None
-        for attempt in range(max_retries):
-            try:
-                segments = segment_dialogue_with_llm(
-                    messages=messages,
-                    model=model,
-                    temperature=temperature
-                )
-                break  
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    print(f"  ⚠️  Retry {attempt + 1}/{max_retries} for {conv_id}/{session_id}: {e}")
-                    time.sleep(retry_delay * (attempt + 1))  
-                else:
-                    print(f"  ❌ Failed after {max_retries} attempts for {conv_id}/{session_id}: {e}")
-                    segments = [{
-                        "segment_id": "seg_1",
-                        "title": "Full conversation (segmentation failed)",
-                        "summary": f"Segmentation failed: {str(e)}",
-                        "key_entities": [],
-                        "salient_facts": [],
-                        "turn_indices": list(range(1, len(messages) + 1)),
-                        "boundary_reason": None,
-                        "error": str(e)
-                    }]
+        # API errors are retried with exponential backoff and jitter, honoring Retry-After; a session that
+        # still fails falls back to a single segment carrying the error
+        segments = segment_dialogue_with_llm(
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            cache=cache,
+            retry_policy=retry_policy
+        )
+        if segments and segments[0].get("error"):
+            print(f"  ❌ Failed for {conv_id}/{session_id}: {segments[0]['error']}")
         
         segmented_dialogs.append({
             "session_id": session_id,
@@ -103,7 +102,9 @@ def process_locomo_batch(
     start_idx: int = 0,
     end_idx: int = None,
     retry_delay: float = 1.0,
-    max_retries: int = 3
+    max_retries: int = 3,
+    cache=None,
+    metrics_path: str = None
 ):
     """
     Process Locomo dataset in batch mode, saving each conversation separately.
@@ -117,6 +118,8 @@ def process_locomo_batch(
         end_idx: End index for processing (None for all)
         retry_delay: Delay between retries
         max_retries: Maximum retries per session
+        cache: Optional LLMResponseCache shared by all segmentation calls
+        metrics_path: JSON file for the LLM usage and latency (default: <output_dir>/llm_metrics.json)
     """
     print(f"Loading data from {input_path}...")
     with open(input_path, 'r', encoding='utf-8') as f:
@@ -133,6 +136,11 @@ def process_locomo_batch(
     total_processed = 0
     total_failed = 0
     total_segments = 0
+    retry_policy = RetryPolicy(
+        max_attempts=max_retries,
+        base_delay=retry_delay,
+        on_retry=lambda e: llm_metrics.record_retry(model, e, site="segment")
+    )
     
     for i, conv in enumerate(tqdm(data_to_process, desc="Segmenting conversations")):
         conv_id = conv.get("conv_id", f"conv_{start_idx + i}")
@@ -148,7 +156,9 @@ def process_locomo_batch(
                 model=model,
                 temperature=temperature,
                 retry_delay=retry_delay,
-                max_retries=max_retries
+                max_retries=max_retries,
+                cache=cache,
+                retry_policy=retry_policy
             )
             
             with open(output_path, 'w', encoding='utf-8') as f:
@@ -173,7 +183,15 @@ def process_locomo_batch(
     print(f"Total segments created: {total_segments}")
     print(f"Average segments per conversation: {total_segments / total_processed:.2f}" if total_processed > 0 else "N/A")
     print(f"Output directory: {output_dir}")
+    if cache is not None:
+        print(f"LLM response cache: {cache.stats()}")
+    print(f"Retries by error class: {retry_policy.stats()}")
     print("="*70)
+    
+    # token usage, latency percentiles, retries and cache hits of the LLM calls
+    metrics_path = metrics_path or os.path.join(output_dir, "llm_metrics.json")
+    llm_metrics.dump(metrics_path)
+    print(f"LLM usage and latency saved to {metrics_path}")
 
 
 def merge_batch_results(
@@ -262,13 +280,37 @@ def main():
         "--retry-delay",
         type=float,
         default=1.0,
-        help="Delay between retries (seconds)"
+        help="Base delay of the exponential backoff between retries (seconds)"
     )
     process_parser.add_argument(
         "--max-retries",
         type=int,
         default=3,
-        help="Maximum retries per session"
+        help="Maximum attempts per session"
+    )
+    process_parser.add_argument(
+        "--cache-path",
+        type=str,
+        default=os.environ.get("LLM_CACHE_PATH", ""),
+        help="SQLite file caching LLM responses across runs (default: from .env or disabled)"
+    )
+    process_parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=None,
+        help="Seconds a cached response stays valid (default: forever)"
+    )
+    process_parser.add_argument(
+        "--cache-max-entries",
+        type=int,
+        default=None,
+        help="Maximum number of cached responses, least recently used ones are evicted beyond it (default: unbounded)"
+    )
+    process_parser.add_argument(
+        "--metrics-path",
+        type=str,
+        default=None,
+        help="JSON file for the token usage and latency of the LLM calls (default: <output-dir>/llm_metrics.json)"
     )
     
     merge_parser = subparsers.add_parser('merge', help='Merge batch results')
@@ -296,6 +338,11 @@ def main():
             print("\nFor Gemini, also set OPENAI_BASE_URL in .env file")
             return
         
+        cache = None
+        if args.cache_path:
+            from SeCom.secom.cache import LLMResponseCache
+            cache = LLMResponseCache(args.cache_path, max_entries=args.cache_max_entries, ttl=args.cache_ttl)
+        
         process_locomo_batch(
             input_path=args.input,
             output_dir=args.output_dir,
@@ -304,7 +351,9 @@ def main():
             start_idx=args.start,
             end_idx=args.end,
             retry_delay=args.retry_delay,
-            max_retries=args.max_retries
+            max_retries=args.max_retries,
+            cache=cache,
+            metrics_path=args.metrics_path
         )
     
     elif args.command == 'merge':
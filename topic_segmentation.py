@@ -11,9 +11,12 @@ from typing import List, Dict, Any, Optional
 from openai import OpenAI
 from tqdm import tqdm
 import argparse
+import time
 from datetime import datetime
 from dotenv import load_dotenv
 
+from SeCom.secom.telemetry import completion_usage, llm_metrics
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -108,7 +111,9 @@ def format_dialogue_for_segmentation(messages: List[Dict[str, str]]) -> str:
 def segment_dialogue_with_llm(
     messages: List[Dict[str, str]], 
     model: str = "gpt-4o",
-    temperature: float = 0.3
+    temperature: float = 0.3,
+    cache=None,
+    retry_policy=None
 ) -> List[Dict[str, Any]]:
     """
     Use LLM to segment a dialogue into coherent topics.
@@ -117,25 +122,47 @@ def segment_dialogue_with_llm(
         messages: List of message dicts with 'role' and 'content'
         model: OpenAI model to use
         temperature: Temperature for generation
+        cache: Optional LLMResponseCache (SeCom/secom/cache.py) to reuse responses of identical requests
+        retry_policy: Optional RetryPolicy (SeCom/secom/retry.py) retrying failed API calls
         
     Returns:
         List of segment dictionaries
     """
     dialogue_text = format_dialogue_for_segmentation(messages)
     prompt = f"{SEGMENTATION_PROMPT}\n\nDialogue:\n{dialogue_text}"
+    request = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": "You are an expert dialogue analyst."},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": temperature,
+        "response_format": {"type": "json_object"}
+    }
     
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "You are an expert dialogue analyst."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=temperature,
-            response_format={"type": "json_object"}
-        )
+        cache_key = cache.make_request_key(request) if cache is not None else None
+        result = cache.get(cache_key) if cache is not None else None
+        if result is None:
+            # usage and latency (retries included) are recorded in llm_metrics under the "segment" call site
+            start_time = time.monotonic()
+            try:
+                if retry_policy is not None:
+                    # the policy replaces the built-in retries of the client
+                    create = client.with_options(max_retries=0).chat.completions.create
+                    response = retry_policy.call(create, **request)
+                else:
+                    response = client.chat.completions.create(**request)
+            except Exception:
+                llm_metrics.record_error(model, site="segment")
+                raise
+            llm_metrics.record_call(
+                model, time.monotonic() - start_time, *completion_usage(response), site="segment"
+            )
+            result = response.choices[0].message.content
+        else:
+            llm_metrics.record_cache_hit(model, site="segment")
         
-        result = response.choices[0].message.content
         
         # Parse the JSON response
         # Sometimes the model wraps the array in an object
@@ -154,6 +181,10 @@ def segment_dialogue_with_llm(
                     segments = []
         else:
             segments = parsed
+        
+        # Only cache responses that parsed, so a malformed one is retried on the next run
+        if cache is not None:
+            cache.set(cache_key, result)
             
         return segments
         
@@ -178,7 +209,8 @@ def process_locomo_data(
     model: str = "gpt-4o",
     temperature: float = 0.3,
     limit: Optional[int] = None,
-    start: int = 0
+    start: int = 0,
+    cache=None
 ):
     """
     Process Locomo dataset and add topic segmentation.
@@ -190,6 +222,7 @@ def process_locomo_data(
         temperature: Temperature for generation
         limit: Optional limit on number of conversations to process (None = all)
         start: Start index (default: 0)
+        cache: Optional LLMResponseCache shared by all segmentation calls
     """
     print(f"Loading data from {input_path}...")
     with open(input_path, 'r', encoding='utf-8') as f:
@@ -237,7 +270,8 @@ def process_locomo_data(
             segments = segment_dialogue_with_llm(
                 messages=messages,
                 model=model,
-                temperature=temperature
+                temperature=temperature,
+                cache=cache
             )
             
             segmented_dialogs.append({
@@ -275,6 +309,8 @@ def process_locomo_data(
     print(f"  Total sessions: {total_sessions}")
     print(f"  Total segments: {total_segments}")
     print(f"  Average segments per session: {total_segments / total_sessions:.2f}")
+    if cache is not None:
+        print(f"  LLM response cache: {cache.stats()}")
 
 
 def main():
@@ -332,6 +368,30 @@ Examples:
         default=0,
         help="Start index for processing (default: 0)"
     )
+    parser.add_argument(
+        "--cache-path",
+        type=str,
+        default=os.environ.get("LLM_CACHE_PATH", ""),
+        help="SQLite file caching LLM responses across runs (default: from .env or disabled)"
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=None,
+        help="Seconds a cached response stays valid (default: forever)"
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        type=int,
+        default=None,
+        help="Maximum number of cached responses, least recently used ones are evicted beyond it (default: unbounded)"
+    )
+    parser.add_argument(
+        "--metrics-path",
+        type=str,
+        default=None,
+        help="JSON file for the token usage and latency of the LLM calls (default: <output>_llm_metrics.json)"
+    )
     
     args = parser.parse_args()
     
@@ -363,8 +423,15 @@ Examples:
     print(f"Output: {args.output}")
     if os.environ.get("OPENAI_BASE_URL"):
         print(f"Base URL: {os.environ.get('OPENAI_BASE_URL')}")
+    if args.cache_path:
+        print(f"LLM cache: {args.cache_path}")
     print("="*70 + "\n")
     
+    cache = None
+    if args.cache_path:
+        from SeCom.secom.cache import LLMResponseCache
+        cache = LLMResponseCache(args.cache_path, max_entries=args.cache_max_entries, ttl=args.cache_ttl)
+    
     try:
         process_locomo_data(
             input_path=args.input,
@@ -372,7 +439,8 @@ Examples:
             model=model,
             temperature=temperature,
             limit=limit,
-            start=args.start
+            start=args.start,
+            cache=cache
         )
     except Exception as e:
         print(f"\n❌ Error: {e}")
@@ -381,6 +449,10 @@ Examples:
         print("  2. Verify base URL if using custom endpoint")
         print("  3. Ensure model name is correct")
         raise
+    finally:
+        metrics_path = args.metrics_path or os.path.splitext(args.output)[0] + "_llm_metrics.json"
+        llm_metrics.dump(metrics_path)
+        print(f"LLM usage and latency saved to {metrics_path}")
 
 
 if __name__ == "__main__":